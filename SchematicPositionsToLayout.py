@@ -1,23 +1,244 @@
 from __future__ import print_function
+import functools
+import hashlib
+import heapq
+import json
+import logging
+import logging.handlers
+import math
+import mmap
 import os
+import platform
 import re
+import struct
 import sys
-import pcbnew
+import threading
+import time
+from array import array
+try:
+    import pcbnew
+except ImportError:
+    # Not running under KiCad. The placement code can still be used
+    # with a MemoryBoard.
+    pcbnew = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from collections import defaultdict
-import shlex
+# The S-expression parser lives in SchematicSexpr.py, next to this
+# file, where the KiCad 5/6 plugin can use it too.
+try:
+    from .SchematicSexpr import NodeIndex, map_file, parse_ast
+except ImportError:
+    from SchematicSexpr import NodeIndex, map_file, parse_ast
 
 
-DEBUG = None
+# Diagnostics go to this logger. By default only warnings get through
+# and debug messages cost nothing, not even formatting. With VERBOSE
+# set, each run logs at LOG_LEVEL to LOG_FILE next to the board. The
+# records are buffered, LOG_BUFFER at a time, and if LOG_MAX_BYTES is
+# non-zero the file is rotated once it reaches that size, keeping
+# LOG_BACKUPS old files.
+log = logging.getLogger('SchematicPositionsToLayout')
+VERBOSE = False
+LOG_LEVEL = logging.DEBUG
+LOG_FILE = 'schematic-positions-to-layout.debug'
+LOG_BUFFER = 1024
+LOG_MAX_BYTES = 0
+LOG_BACKUPS = 3
+
+# Data extracted from schematic sheets is cached between runs in a file
+# next to the board, so that re-running the plugin on an unchanged
+# schematic skips parsing. Set PARSE_CACHE to False to bypass the
+# cache. Least recently used entries are dropped once the cache file
+# would grow beyond PARSE_CACHE_MAX_BYTES.
+PARSE_CACHE = True
+PARSE_CACHE_FILE = 'schematic-positions-to-layout.cache'
+PARSE_CACHE_MAX_BYTES = 4 << 20
+PARSE_CACHE_VERSION = 3
+
+# Number of worker processes used to parse sheet files. 1 parses
+# everything in the current process, and 0 means one per CPU. The
+# plugin parses in-process: it runs inside the Pcbnew GUI, which it
+# isn't safe to start worker processes from. The command line tool
+# uses one worker per CPU.
+PARSE_WORKERS = 1
+
+# In incremental mode, the position each footprint was last placed at
+# is saved in PLACEMENT_STATE_FILE next to the board, and on the next
+# run only footprints that are new, or whose schematic position or
+# sheet offset has changed since, are moved. Manual adjustments to the
+# other footprints are kept.
+INCREMENTAL = False
+PLACEMENT_STATE_FILE = 'schematic-positions-to-layout.state'
+PLACEMENT_STATE_VERSION = 1
+
+# The placements worked out for a board can be saved in a compact
+# binary placement file (see write_placement_file) and replayed onto
+# the same or another board later without reading the schematic. With
+# PLACEMENT_EXPORT set, each run saves them to PLACEMENT_FILE next to
+# the board.
+PLACEMENT_EXPORT = False
+PLACEMENT_FILE = 'schematic-positions-to-layout.placements'
+PLACEMENT_FILE_MAGIC = b'SPTLPLAC'
+PLACEMENT_FILE_VERSION = 1
+
+# In watch mode the sheets and the placements worked out from them are
+# kept in memory between runs, and a background thread checks the
+# sheet files for changes every WATCH_INTERVAL seconds. Changes are
+# only read once the files have been left alone for WATCH_DEBOUNCE
+# seconds, so a burst of saves is handled once, and then only the
+# sheet files that changed are parsed again.
+WATCH = False
+WATCH_INTERVAL = 1.0
+WATCH_DEBOUNCE = 0.5
+
+# How the sheets are arranged on the board: 'pack' packs their
+# bounding boxes into a roughly square area, 'vertical' stacks them
+# one below the other, and 'hierarchy' places each sheet according to
+# where its sheet symbol is on its parent sheet. Each sheet gets
+# SHEET_SPACING times the space its contents take up, and at least
+# SHEET_MIN_SIZE (in schematic units of 0.01 mm) each way when packed
+# or laid out by hierarchy.
+SHEET_LAYOUT = 'pack'
+SHEET_SPACING = 1.25
+SHEET_MIN_SIZE = 1000
+
+# For the 'hierarchy' layout, SHEET_HIERARCHY_FIT says where a sheet's
+# contents go relative to its sheet symbol: 'into' scales them down to
+# fit inside the symbol, as if zooming into it, and 'beside' keeps them
+# at full scale in a column to the right of the parent sheet, each
+# sheet level with its symbol as far as its siblings allow.
+SHEET_HIERARCHY_FIT = 'beside'
+
+# Footprints are matched to schematic symbols by path. With
+# MATCH_FALLBACK set, a footprint whose path isn't in the schematic
+# (after re-annotation, a change of sheet UUID, or a board made from an
+# older netlist, say) is matched instead by the symbol UUID at the end
+# of its path, then by its reference on the same sheet, then by its
+# reference alone, whichever first gives a single symbol not already
+# matched.
+MATCH_FALLBACK = True
+
+# Footprints placed straight from the schematic often overlap. With
+# RESOLVE_OVERLAPS set, overlapping footprints are pushed apart after
+# placement, each to the nearest spot where there is OVERLAP_CLEARANCE
+# (in nm) between its courtyard and the others.
+RESOLVE_OVERLAPS = False
+OVERLAP_CLEARANCE = 250000
+
+# With AUTO_SCALE set, POS_SCALE is replaced by a scale worked out for
+# each sheet from the footprints on the board, so that their courtyards
+# cover about AUTO_SCALE_FILL of the area the sheet takes up. With
+# AUTO_SCALE_OUTLINE set too, the layout is then shrunk if need be to
+# fit the footprints' courtyards inside the board outline, if there is
+# one, and moved inside it; moving footprints apart (RESOLVE_OVERLAPS)
+# then keeps them inside it too.
+AUTO_SCALE = False
+AUTO_SCALE_FILL = 0.2
+AUTO_SCALE_OUTLINE = True
+
+# With STATS set, each run appends a report to STATS_FILE next to the
+# board, as one line of JSON: the wall and CPU time spent in each phase
+# of the run and counts of what was processed, for comparing runs
+# across boards and KiCad versions. With STATS_PROFILE set too, the
+# run is profiled with cProfile, the profile saved to
+# STATS_PROFILE_FILE and the STATS_PROFILE_TOP functions with the most
+# cumulative time listed in the report. CPU times and the profile only
+# cover this process, not the parse worker processes.
+STATS = False
+STATS_FILE = 'schematic-positions-to-layout.stats'
+STATS_VERSION = 1
+STATS_PROFILE = False
+STATS_PROFILE_FILE = 'schematic-positions-to-layout.prof'
+STATS_PROFILE_TOP = 20
+
+
+# Timer for one phase of a run, adding the wall and CPU time spent in
+# it to the totals for the phase.
+class StatsPhase:
+    def __init__(self, totals):
+        self.totals = totals
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.totals[0] += time.perf_counter() - self.wall
+        self.totals[1] += time.process_time() - self.cpu
+        self.totals[2] += 1
+        return False
+
+# Phase timings and counters for the current run. They are always
+# collected, being cheap, and reset by start_stats. Phases nest, so
+# the time for one includes any phases run inside it. A background
+# thread can be given its own RunStats with use(), so its work isn't
+# counted in the run it happens to overlap.
+class RunStats:
+    def __init__(self):
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.phases = dict()
+        self.counters = defaultdict(int)
+
+    # The RunStats the calling thread records to.
+    def target(self):
+        return getattr(self.local, 'stats', None) or self
+
+    # Record the calling thread's timings and counts to other until
+    # stopped with use(None).
+    def use(self, other):
+        self.local.stats = other
+
+    # Context manager timing a phase.
+    def phase(self, name):
+        target = self.target()
+        totals = target.phases.get(name)
+        if totals is None:
+            totals = target.phases[name] = [0.0, 0.0, 0]
+        return StatsPhase(totals)
+
+    # Decorator timing every call of a function as a phase.
+    def timed(self, name):
+        def decorate(fn):
+            @functools.wraps(fn)
+            def timed_fn(*args, **kwargs):
+                with self.phase(name):
+                    return fn(*args, **kwargs)
+            return timed_fn
+        return decorate
+
+    def count(self, name, n=1):
+        self.target().counters[name] += n
+
+    # The timings and counters as plain JSON-friendly values.
+    def report(self):
+        return {'phases': dict((name, {'wall': wall, 'cpu': cpu, 'calls': calls})
+                               for name, (wall, cpu, calls) in self.phases.items()),
+                'counters': dict(self.counters)}
+
+stats = RunStats()
 
 # Tokenizer for schematic file input lines.
 def tokens(s):
     return re.split(r' +', s)
 
-# Class to represent a single sheet of a schematic. Has a map from
-# component IDs to positions, a map from sub-sheet names to sub-sheet
-# schematic file names, plus coordinate ranges for the component
-# positions.
+# Class to represent a single sheet of a schematic. Has the
+# components' IDs, references and positions in parallel columns with a
+# map from component ID to row, a map from sub-sheet names to
+# sub-sheet schematic file names, plus coordinate ranges for the
+# component positions.
 class SchSheet:
+    # Top-level node types that walk() looks at. Everything else in the
+    # file (library symbols, wires, text and so on) is skipped by the
+    # parser without being built.
+    PARSE_NODES = ('symbol', 'sheet')
+
     # Extend x- and y-coordinate ranges based on new component or
     # sub-sheet values.
     def extend_range(self, x, y):
@@ -30,66 +251,71 @@ class SchSheet:
         if self.yrange[1] is None or y > self.yrange[1]:
             self.yrange[1] = y
 
-    def __init__(self, file):
-        self.components = dict()
+    # Initialise from schematic file, or from previously extracted
+    # sheet data (from the parse cache or a worker process).
+    def __init__(self, file, data=None):
+        self.component_ids = []
+        self.refs = []
+        self.xs = array('i')
+        self.ys = array('i')
+        self.component_rows = dict()
         self.sub_sheets = dict()
+        self.sheet_blocks = dict()
 
-        print('New sheet from:', file)
+        log.debug('New sheet from: %s', file)
 
         self.xrange = [None, None]
         self.yrange = [None, None]
+        self.bytes = 0
+        self.tokens = 0
 
-        ast = self.parse_ast(file)
+        if data is not None:
+            self.load(data)
+            return
+        ast = self.parse_ast(file, self.PARSE_NODES)
         self.walk(ast)
 
-    def parse_ast(self, filename):
-        Symbol = str              # A Scheme Symbol is implemented as a Python str
-        Number = (int, float)     # A Scheme Number is implemented as a Python int or float
-        Atom   = (Symbol, Number) # A Scheme Atom is a Symbol or Number
-        List   = list             # A Scheme List is implemented as a Python list
-        Exp    = (Atom, List)     # A Scheme expression is an Atom or List
-        Env    = dict             # A Scheme environment (defined below) 
-                                  # is a mapping of {variable: value}
-
-        def tokenize(chars: str) -> list:
-            "Convert a string of characters into a list of tokens."
-            return shlex.split(chars.replace('(', ' ( ').replace(')', ' ) '))
-
-        def parse(program: str) -> Exp:
-            "Read a Scheme expression from a string."
-            return read_from_tokens(tokenize(program))
-
-        def read_from_tokens(tokens: list) -> Exp:
-            "Read an expression from a sequence of tokens."
-            if len(tokens) == 0:
-                raise SyntaxError('unexpected EOF')
-            token = tokens.pop(0)
-            if token == '(':
-                L = []
-                while tokens[0] != ')':
-                    L.append(read_from_tokens(tokens))
-                tokens.pop(0) # pop off ')'
-                return L
-            elif token == ')':
-                raise SyntaxError('unexpected )')
-            else:
-                return atom(token)
-
-        def atom(token: str) -> Atom:
-            "Numbers become numbers; every other token is a symbol."
-            try: return int(token)
-            except ValueError:
-                try: return float(token)
-                except ValueError:
-                    return Symbol(token)
-        
-        with open(filename,encoding='utf-8') as f:
-            data = f.read()
+    # Convert the extracted sheet data to and from plain JSON-friendly
+    # values.
+    def dump(self):
+        return [self.component_ids, self.refs, self.xs.tolist(), self.ys.tolist(),
+                self.sub_sheets, self.sheet_blocks, self.xrange, self.yrange]
+
+    def load(self, data):
+        (component_ids, self.refs, xs, ys, sub_sheets, sheet_blocks,
+         self.xrange, self.yrange) = data
+        self.component_ids = component_ids
+        self.xs = array('i', xs)
+        self.ys = array('i', ys)
+        self.component_rows = dict(zip(component_ids, range(len(component_ids))))
+        for sid, (name, file) in sub_sheets.items():
+            self.sub_sheets[sid] = (name, file)
+        for sid, bounds in sheet_blocks.items():
+            self.sheet_blocks[sid] = tuple(bounds)
+
+    # Record a component, replacing any earlier one with the same ID.
+    def add_component(self, component_id, component_ref, component_pos):
+        row = self.component_rows.get(component_id)
+        if row is None:
+            self.component_rows[component_id] = len(self.component_ids)
+            self.component_ids.append(component_id)
+            self.refs.append(component_ref)
+            self.xs.append(component_pos[0])
+            self.ys.append(component_pos[1])
+        else:
+            self.refs[row] = component_ref
+            self.xs[row] = component_pos[0]
+            self.ys[row] = component_pos[1]
 
-        #ast = OneOrMore(nestedExpr()).parseString(data, parseAll=True)
-        ast = parse(data)
+    # Parse the file with the shared parser (see SchematicSexpr),
+    # keeping count of what was read.
+    def parse_ast(self, filename, keep=None):
+        ast, self.tokens, self.bytes = parse_ast(filename, keep)
         return ast
-    
+
+    # The old per-call lookups on a node's children, which walk() now
+    # does through a NodeIndex. They are only kept so that
+    # benchmarks/bench_lookup.py can compare the two.
     def pick(self, lst, *attribute_names):
         attr_pool = defaultdict(list)
         for i in attribute_names:
@@ -122,50 +348,1694 @@ class SchSheet:
         for i in ast:
             token = i[0]
             if token == 'symbol':  #  Process start and end of component
-                component_ref = self.pick_property(i[1:], "Reference")
-                component_id = self.pick(i[1:], "uuid")['uuid'][0]
-                component_pos = tuple(map(position_convert, self.pick(i[1:], "at")['at']))[:2]
-                self.components[component_id] = (component_ref, component_pos)
+                node = NodeIndex(i)
+                component_ref = node.prop("Reference")
+                component_id = node.field('uuid')[0]
+                component_pos = tuple(map(position_convert, node.field('at')))[:2]
+                self.add_component(component_id, component_ref, component_pos)
                 self.extend_range(component_pos[0], component_pos[1])
             elif token == 'sheet': # Handle sub-sheet
-                sheet_bounds_ast = self.pick(i[1:], 'at', 'size')
-                sheet_bounds = tuple(map(position_convert, sheet_bounds_ast['at'] + sheet_bounds_ast['size']))
-                sheet_id = self.pick(i[1:], "uuid")['uuid'][0]
-                sheet_name = self.pick_property(i[1:], "Sheetname")
-                sheet_file = self.pick_property(i[1:], "Sheetfile")
+                node = NodeIndex(i)
+                sheet_bounds = tuple(map(position_convert, node.field('at') + node.field('size')))
+                sheet_id = node.field('uuid')[0]
+                sheet_name = node.prop("Sheetname")
+                sheet_file = node.prop("Sheetfile")
                 self.sub_sheets[sheet_id] = (sheet_name, sheet_file)
+                self.sheet_blocks[sheet_id] = sheet_bounds[:4]
                 self.extend_range(sheet_bounds[0], sheet_bounds[1])
                 self.extend_range(sheet_bounds[0] + sheet_bounds[2],
                                   sheet_bounds[1] + sheet_bounds[3])
 
+
+# Digest of a file's contents, used to recognise unchanged files whose
+# modification time has changed.
+def file_digest(file):
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Persistent cache of extracted sheet data, keyed by absolute file
+# path. An entry is used if the file's size and modification time are
+# unchanged, or failing that if the contents hash to the same value.
+# An unreadable or out of date cache file is treated as empty.
+class SheetCache:
+    def __init__(self, path, max_bytes=PARSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries = dict()
+        self.pending = dict()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(path, encoding='utf-8') as fp:
+                cached = json.load(fp)
+            if cached['version'] == PARSE_CACHE_VERSION:
+                self.entries = cached['entries']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.clock = max([e['used'] for e in self.entries.values()] + [0])
+
+    # Return cached sheet data for a file, or None on a miss.
+    def get(self, file):
+        key = os.path.abspath(file)
+        st = os.stat(key)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self.entries.get(key)
+        if entry is None or entry['stamp'] != stamp:
+            digest = file_digest(key)
+            if entry is None or entry['hash'] != digest:
+                self.pending[key] = (stamp, digest)
+                self.misses += 1
+                return None
+            entry['stamp'] = stamp
+        self.clock += 1
+        entry['used'] = self.clock
+        self.dirty = True
+        self.hits += 1
+        return entry['data']
+
+    # Store sheet data for a file after a miss. The stamp and digest
+    # are the ones taken before the file was parsed, so a file that
+    # changes while it's being read is never cached as up to date.
+    def put(self, file, data):
+        key = os.path.abspath(file)
+        if key not in self.pending:
+            return
+        stamp, digest = self.pending.pop(key)
+        self.clock += 1
+        self.entries[key] = {'stamp': stamp, 'hash': digest,
+                             'used': self.clock, 'data': data}
+        self.dirty = True
+
+    # Write the cache back, keeping the most recently used entries
+    # that fit in the size limit.
+    def save(self):
+        if not self.dirty:
+            return
+        kept = dict()
+        size = 0
+        for key, entry in sorted(self.entries.items(),
+                                 key=lambda item: -item[1]['used']):
+            size += len(key) + len(json.dumps(entry, separators=(',', ':')))
+            if size > self.max_bytes:
+                break
+            kept[key] = entry
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as fp:
+                json.dump({'version': PARSE_CACHE_VERSION, 'entries': kept},
+                          fp, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except OSError as err:
+            log.warning('Failed writing parse cache: %s', err)
+        self.dirty = False
+
+# Key identifying a schematic file, however the path to it is spelled.
+def sheet_file_key(file_name):
+    return os.path.normcase(os.path.abspath(file_name))
+
+# Parse one sheet file, returning the extracted data and the number of
+# bytes and tokens read. This is what runs in the worker processes.
+def parse_sheet_file(file_name):
+    sheet = SchSheet(file_name)
+    return sheet.dump(), sheet.bytes, sheet.tokens
+
+# Process pool for parsing sheets with the given number of workers (as
+# for PARSE_WORKERS), or None if parsing should be done in-process:
+# with one worker, on a single CPU, or if a pool can't be started. The
+# workers are spawned rather than forked, so that the pool can be
+# started from a thread (a watcher's, say) without copying the state
+# of the other threads.
+def make_parse_pool(workers):
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    try:
+        import concurrent.futures
+        import multiprocessing
+        return concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+    except (ImportError, OSError, NotImplementedError, ValueError) as err:
+        log.info('Parsing serially, no process pool: %s', err)
+        return None
+
+# Read every schematic file reachable from the root file, returning a
+# map from file key to SchSheet. Files come from the parse cache if
+# possible. Otherwise they are handed to a process pool as soon as the
+# sheet referring to them has been read, so independent sheets are
+# parsed in parallel. The pool is only started once there is more than
+# one file to parse at a time, and if it's unavailable or a worker
+# fails the file is parsed here instead. The result doesn't depend on
+# the order the workers finish in, since the hierarchy is assembled
+# from this map afterwards. Sheets in known (a map like the one
+# returned) are taken as they are, without reading their files.
+# workers defaults to PARSE_WORKERS.
+@stats.timed('parse')
+def read_sheet_files(root_file, cache=None, workers=None, known=None):
+    if workers is None:
+        workers = PARSE_WORKERS
+    sheet_files = dict()
+    seen = set()
+    todo = [root_file]
+    pending = dict()
+    pool = None
+
+    def add(key, sheet):
+        sheet_files[key] = sheet
+        todo.extend(sub_file for _, sub_file in sheet.sub_sheets.values())
+
+    def found(file_name, data):
+        add(sheet_file_key(file_name), SchSheet(file_name, data))
+
+    def parsed(file_name, result):
+        data, nbytes, tokens = result
+        stats.count('files parsed')
+        stats.count('bytes parsed', nbytes)
+        stats.count('tokens', tokens)
+        if cache is not None:
+            cache.put(file_name, data)
+        found(file_name, data)
+
+    try:
+        while todo or pending:
+            to_parse = []
+            while todo:
+                file_name = todo.pop(0)
+                key = sheet_file_key(file_name)
+                if key in seen:
+                    continue
+                seen.add(key)
+                if known is not None and key in known:
+                    add(key, known[key])
+                    continue
+                data = cache.get(file_name) if cache is not None else None
+                if data is not None:
+                    stats.count('files cached')
+                    found(file_name, data)
+                else:
+                    to_parse.append(file_name)
+            if pool is None and len(to_parse) + len(pending) > 1:
+                pool = make_parse_pool(workers)
+                workers = 1 if pool is None else workers
+            for file_name in to_parse:
+                if pool is not None:
+                    pending[pool.submit(parse_sheet_file, file_name)] = file_name
+                else:
+                    parsed(file_name, parse_sheet_file(file_name))
+            if pending:
+                import concurrent.futures
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    file_name = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        log.warning('Worker failed on %s: %s', file_name, err)
+                        result = parse_sheet_file(file_name)
+                    parsed(file_name, result)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    stats.count('unique files', len(sheet_files))
+    return sheet_files
+
 POS_SCALE = 5000
 
-def move_modules(components, board, offsets):
-    selection_active = False
-    for module in board.GetFootprints():
-        if module.IsSelected():
-            selection_active = True
-    for module in board.GetFootprints():
-        old_pos = module.GetPosition()
-        ref = module.GetReference()
-        path = '/' + '/'.join([x.AsString() for x in module.GetPath()])
-        print(ref, path, file=DEBUG)
-        if path in components:
-            ref, pos, sheet = components[path]
-            if module.IsLocked():
-                print('  path =', path, '  sheet =', sheet, '  ref =', ref, ' is locked, skip', file=DEBUG)
+# Board coordinates are 32-bit integers, in nm, so a board only reaches
+# about 2.147 m from the origin either way. VECTOR2I won't take a
+# position outside BOARD_RANGE, and MemoryBoard won't either.
+BOARD_RANGE = (-(1 << 31), (1 << 31) - 1)
+
+# Board adapters. The placement code only needs a few things from a
+# board and goes through one of these rather than calling pcbnew
+# directly: PcbnewBoard wraps a pcbnew BOARD, and MemoryBoard is an
+# in-memory stand-in for benchmarking and for running without KiCad.
+# snapshot() yields (footprint, reference, path, locked, selected, x,
+# y) for every footprint in one pass, and set_positions() takes a list
+# of (footprint, x, y) to move. extent() gives the (left, top, right,
+# bottom) of a footprint's courtyard relative to its position, and
+# outline() the (left, top, right, bottom) of the board outline, or
+# None. Positions are in board units (nm).
+class PcbnewBoard:
+    def __init__(self, board):
+        self.board = board
+
+    def file_name(self):
+        return self.board.GetFileName()
+
+    def snapshot(self):
+        for fp in self.board.GetFootprints():
+            pos = fp.GetPosition()
+            yield (fp, fp.GetReference(), fp.GetPath().AsString(),
+                   fp.IsLocked(), fp.IsSelected(), pos.x, pos.y)
+
+    # The front or back courtyard, or the footprint's bounding box
+    # without text if it has no courtyard.
+    def extent(self, fp):
+        if hasattr(fp, 'BuildCourtyardCaches'):
+            fp.BuildCourtyardCaches()
+        box = None
+        for layer in (pcbnew.F_CrtYd, pcbnew.B_CrtYd):
+            courtyard = fp.GetCourtyard(layer)
+            if courtyard.OutlineCount() > 0:
+                box = courtyard.BBox()
+                break
+        if box is None:
+            box = fp.GetBoundingBox(False, False)
+        pos = fp.GetPosition()
+        return (box.GetLeft() - pos.x, box.GetTop() - pos.y,
+                box.GetRight() - pos.x, box.GetBottom() - pos.y)
+
+    def outline(self):
+        box = self.board.GetBoardEdgesBoundingBox()
+        if box.GetWidth() <= 0 or box.GetHeight() <= 0:
+            return None
+        return (box.GetLeft(), box.GetTop(), box.GetRight(), box.GetBottom())
+
+    def set_positions(self, changes):
+        VECTOR2I = pcbnew.VECTOR2I
+        for fp, x, y in changes:
+            fp.SetPosition(VECTOR2I(x, y))
+
+# Footprint on a MemoryBoard. extent is as for PcbnewBoard.extent().
+class MemoryFootprint:
+    __slots__ = ('reference', 'path', 'x', 'y', 'locked', 'selected', 'extent')
+
+    def __init__(self, reference, path, x=0, y=0, locked=False, selected=False,
+                 extent=(0, 0, 0, 0)):
+        self.reference = reference
+        self.path = path
+        self.x = x
+        self.y = y
+        self.locked = locked
+        self.selected = selected
+        self.extent = extent
+
+class MemoryBoard:
+    def __init__(self, file_name='', footprints=(), board_outline=None):
+        self.board_file = file_name
+        self.fps = list(footprints)
+        self.board_outline = board_outline
+
+    def add(self, reference, path, x=0, y=0, locked=False, selected=False,
+            extent=(0, 0, 0, 0)):
+        fp = MemoryFootprint(reference, path, x, y, locked, selected, extent)
+        self.fps.append(fp)
+        return fp
+
+    def file_name(self):
+        return self.board_file
+
+    def snapshot(self):
+        for fp in self.fps:
+            yield fp, fp.reference, fp.path, fp.locked, fp.selected, fp.x, fp.y
+
+    def extent(self, fp):
+        return fp.extent
+
+    def outline(self):
+        return self.board_outline
+
+    def set_positions(self, changes):
+        low, high = BOARD_RANGE
+        for fp, x, y in changes:
+            if not (low <= x <= high and low <= y <= high):
+                raise OverflowError('position ({}, {}) of {} is outside the board coordinate range'.format(
+                    x, y, fp.reference))
+            fp.x = x
+            fp.y = y
+
+# Snapshot of the footprints on a board, taken in a single pass over
+# the board: one row per footprint in parallel columns, plus a map
+# from footprint path to row.
+class FootprintIndex:
+    def __init__(self, board):
+        self.footprints = []
+        self.refs = []
+        self.paths = []
+        self.locked = bytearray()
+        self.selected = bytearray()
+        self.xs = array('q')
+        self.ys = array('q')
+        for fp, ref, path, locked, selected, x, y in board.snapshot():
+            self.footprints.append(fp)
+            self.refs.append(ref)
+            self.paths.append(path)
+            self.locked.append(bool(locked))
+            self.selected.append(bool(selected))
+            self.xs.append(x)
+            self.ys.append(y)
+        self.rows = dict(zip(self.paths, range(len(self.paths))))
+        self.selection_active = any(self.selected)
+        self.fp_extents = None
+        self.matched = None
+
+    # The footprints matched to placements (see match_footprints),
+    # worked out once for the last placements asked about.
+    def matches(self, placements):
+        if self.matched is None or self.matched[0] is not placements:
+            self.matched = (placements, match_footprints(placements, self))
+        return self.matched[1]
+
+    # Courtyard extents of the footprints, fetched from the board the
+    # first time they're needed.
+    def extents(self, board):
+        if self.fp_extents is None:
+            self.fp_extents = [board.extent(fp) for fp in self.footprints]
+        return self.fp_extents
+
+# Move boxes off each other. boxes is a list of (left, top, right,
+# bottom), and only those with movable set may move; the others are
+# obstacles. Boxes closer than clearance count as overlapping. The
+# movable boxes are placed one at a time, largest first, each where it
+# is if that's free. Otherwise up to tries spots close by are tried,
+# best first: each spot that is blocked by another box leads to the
+# spots just clear of that box on each side. That finds a gap next to
+# the box in the usual case, but in a cluster the number of such spots
+# grows with the square of the cluster's size, so past that the box
+# goes to the nearest free point of a lattice spaced by the typical box
+# size instead. The lattice is searched row by row outward from the
+# box until the rows are further away than the best point so far, and
+# a point found to be blocked is never tried again: runs of blocked
+# points along a row are skipped through a disjoint-set forest for
+# each direction. Boxes already placed are kept in a uniform grid, so
+# checking a spot only looks at the boxes nearby. A box then costs a
+# bounded number of tries, one lattice check per row scanned and its
+# share of the points ever blocked, so n boxes take about n log n
+# steps spread out and no worse than about n * sqrt(n) piled on one
+# spot. Given bounds, (left, top, right, bottom), movable boxes that fit
+# inside it are kept inside it, as if it were walled in; one with no
+# room left inside goes to the nearest free point outside. Returns the
+# (dx, dy) each box was moved by.
+def resolve_overlaps(boxes, movable, clearance=OVERLAP_CLEARANCE, tries=32, bounds=None):
+    moves = [(0, 0)] * len(boxes)
+    if not any(movable):
+        return moves
+    sizes = sorted(max(x1 - x0, y1 - y0) + clearance for x0, y0, x1, y1 in boxes)
+    cell = max(1, sizes[len(sizes) // 2])
+    grid = defaultdict(list)
+    widths = sorted(x1 - x0 + clearance for (x0, _, x1, _), m in zip(boxes, movable) if m)
+    heights = sorted(y1 - y0 + clearance for (_, y0, _, y1), m in zip(boxes, movable) if m)
+    step_x = max(1, widths[len(widths) // 2])
+    step_y = max(1, heights[len(heights) // 2])
+
+    # The first placed box overlapping the given one, or None. Boxes
+    # are grown by the clearance on the right and bottom, so boxes that
+    # only touch don't overlap.
+    def blocker(x0, y0, x1, y1):
+        for cx in range(x0 // cell, (x1 - 1) // cell + 1):
+            for cy in range(y0 // cell, (y1 - 1) // cell + 1):
+                for b in grid.get((cx, cy), ()):
+                    if x0 < b[2] and b[0] < x1 and y0 < b[3] and b[1] < y1:
+                        return b
+        return None
+
+    def place(box):
+        for cx in range(box[0] // cell, (box[2] - 1) // cell + 1):
+            for cy in range(box[1] // cell, (box[3] - 1) // cell + 1):
+                grid[cx, cy].append(box)
+
+    # Walls around bounds, as boxes reaching far out on the other side,
+    # so that a spot crossing one is blocked by it like any other box.
+    # Like the boxes, the right and bottom walls are moved out by the
+    # clearance.
+    walls = ()
+    if bounds is not None:
+        far = 1 << 62
+        walls = ((-far, -far, bounds[0], far), (bounds[2] + clearance, -far, far, far),
+                 (-far, -far, far, bounds[1]), (-far, bounds[3] + clearance, far, far))
+
+    # blocker(), with the walls around bounds too.
+    def walled_blocker(x0, y0, x1, y1):
+        for b in walls:
+            if x0 < b[2] and b[0] < x1 and y0 < b[3] and b[1] < y1:
+                return b
+        return blocker(x0, y0, x1, y1)
+
+    # Blocked lattice points, as links to the next point to try to the
+    # right and to the left, keyed by (column, row).
+    right = dict()
+    left = dict()
+
+    # The first point not known to be blocked from column x along a
+    # row, following (and shortening) the links.
+    def unblocked(links, x, row):
+        passed = []
+        while (x, row) in links:
+            passed.append(x)
+            x = links[x, row]
+        for p in passed:
+            links[p, row] = x
+        return x
+
+    for i, (x0, y0, x1, y1) in enumerate(boxes):
+        if not movable[i]:
+            place((x0, y0, x1 + clearance, y1 + clearance))
+    order = [i for i in range(len(boxes)) if movable[i]]
+    order.sort(key=lambda i: -(boxes[i][2] - boxes[i][0]) * (boxes[i][3] - boxes[i][1]))
+    for i in order:
+        x0, y0, x1, y1 = boxes[i]
+        inside = bounds is not None and x1 - x0 <= bounds[2] - bounds[0] and \
+            y1 - y0 <= bounds[3] - bounds[1]
+        check = walled_blocker if inside else blocker
+        x1 += clearance
+        y1 += clearance
+        # Try the spots just clear of whatever is in the way first, as
+        # they are usually close by.
+        todo = [(0, 0, 0)]
+        tried = set()
+        found = False
+        while todo and len(tried) < tries:
+            _, dx, dy = heapq.heappop(todo)
+            if (dx, dy) in tried:
+                continue
+            tried.add((dx, dy))
+            b = check(x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+            if b is None:
+                found = True
+                break
+            for nx, ny in ((b[2] - x0, dy), (b[0] - x1, dy), (dx, b[3] - y0), (dx, b[1] - y1)):
+                heapq.heappush(todo, (nx * nx + ny * ny, nx, ny))
+        if found:
+            place((x0 + dx, y0 + dy, x1 + dx, y1 + dy))
+            moves[i] = (dx, dy)
+            continue
+        col, row0 = int(round(float(x0) / step_x)), int(round(float(y0) / step_y))
+        # The lattice columns and rows at which the box is inside
+        # bounds, if it's being kept inside; if there are none, or none
+        # of them is free, the box goes outside after all.
+        span = None
+        if inside:
+            span = (-(-bounds[0] // step_x), (bounds[2] + clearance - (x1 - x0)) // step_x,
+                    -(-bounds[1] // step_y), (bounds[3] + clearance - (y1 - y0)) // step_y)
+            if span[0] > span[1] or span[2] > span[3]:
+                span = None
+        best = None
+        k = 0
+        while True:
+            scanned = False
+            for row in ((row0,) if k == 0 else (row0 + k, row0 - k)):
+                dy = row * step_y - y0
+                if best is not None and dy * dy >= best[0]:
+                    continue
+                if span is not None and not span[2] <= row <= span[3]:
+                    continue
+                scanned = True
+                starts = (col, col - 1)
+                if span is not None:
+                    starts = (max(col, span[0]), min(col - 1, span[1]))
+                for links, start, direction in ((right, starts[0], 1), (left, starts[1], -1)):
+                    x = start
+                    while True:
+                        x = unblocked(links, x, row)
+                        if span is not None and not span[0] <= x <= span[1]:
+                            break
+                        dx = x * step_x - x0
+                        d = dx * dx + dy * dy
+                        if best is not None and d >= best[0]:
+                            break
+                        if blocker(x0 + dx, y0 + dy, x1 + dx, y1 + dy) is None:
+                            best = (d, dx, dy, x, row)
+                            break
+                        right[x, row] = x + 1
+                        left[x, row] = x - 1
+                        x += direction
+            if best is not None and not scanned:
+                break
+            if best is None and span is not None and row0 - k <= span[2] and row0 + k >= span[3]:
+                # Every row inside has been scanned and nothing is free.
+                span = None
+                k = 0
+                continue
+            k += 1
+        _, dx, dy, x, row = best
+        right[x, row] = x + 1
+        left[x, row] = x - 1
+        place((x0 + dx, y0 + dy, x1 + dx, y1 + dy))
+        moves[i] = (dx, dy)
+    return moves
+
+# Move the footprints in targets, a list of (row, (x, y)) in a
+# FootprintIndex, off each other and off the footprints that stay put,
+# keeping their courtyards inside bounds if given. Returns their
+# adjusted positions, in the same order.
+def spread_footprints(board, index, targets, bounds=None):
+    target_rows = dict(targets)
+    boxes = []
+    movable = []
+    for row, (left, top, right, bottom) in enumerate(index.extents(board)):
+        x, y = target_rows.get(row, (index.xs[row], index.ys[row]))
+        boxes.append((x + left, y + top, x + right, y + bottom))
+        movable.append(row in target_rows)
+    moves = resolve_overlaps(boxes, movable, bounds=bounds)
+    log.info('%d footprints moved off others',
+             sum(1 for row, _ in targets if moves[row] != (0, 0)))
+    return [(x + moves[row][0], y + moves[row][1]) for row, (x, y) in targets]
+
+# Ways of matching footprints to symbols, in the order they're tried.
+MATCH_METHODS = ('path', 'symbol', 'sheet reference', 'reference')
+MATCH_AMBIGUOUS = -1
+
+# Footprints of a FootprintIndex matched to placements: the placement
+# row and computed position for each footprint row (None if
+# unmatched), and how many were matched each way. get() looks up a
+# footprint path, like Placements.get.
+class FootprintMatches:
+    def __init__(self, index):
+        self.rows = index.rows
+        self.matched = [None] * len(index.paths)
+        self.positions = [None] * len(index.paths)
+        self.counts = dict.fromkeys(MATCH_METHODS + ('not found',), 0)
+
+    def get(self, path):
+        row = self.rows.get(path)
+        return None if row is None else self.positions[row]
+
+
+# Match the footprints of a FootprintIndex to placements (Placements
+# or a PlacementFile). Each footprint is matched by path if possible,
+# and otherwise, with MATCH_FALLBACK set, by the methods after 'path'
+# in MATCH_METHODS in turn, each of which looks the footprint up in a
+# hash index of the placements. Keys that more than one symbol has
+# (the symbol UUIDs of a sheet used several times, for instance) are
+# marked ambiguous and never match. Each symbol is matched to at most
+# one footprint, path matches having first pick, and the fallback
+# indexes are only built if some footprints are left over.
+def match_footprints(placements, index, fallback=None):
+    if fallback is None:
+        fallback = MATCH_FALLBACK
+    matches = FootprintMatches(index)
+    counts = matches.counts
+    claimed = set()
+    left = []
+    for row, path in enumerate(index.paths):
+        match = placements.row(path)
+        if match is None:
+            left.append(row)
+        else:
+            claimed.add(match)
+            matches.matched[row] = match
+            matches.positions[row] = placements.at(match)
+            counts['path'] += 1
+
+    if left and fallback:
+        by_symbol = dict()
+        by_sheet_ref = dict()
+        by_ref = dict()
+
+        def add(keys, key, row):
+            if keys.setdefault(key, row) != row:
+                keys[key] = MATCH_AMBIGUOUS
+
+        for row, sheet_path, cid, ref in placements.entries():
+            add(by_symbol, cid, row)
+            add(by_sheet_ref, (sheet_path, ref), row)
+            add(by_ref, ref, row)
+        debug = log.isEnabledFor(logging.DEBUG)
+        for row in left:
+            path, ref = index.paths[row], index.refs[row]
+            sheet_path, _, cid = path.rpartition('/')
+            for method, keys, key in (('symbol', by_symbol, cid),
+                                      ('sheet reference', by_sheet_ref, (sheet_path, ref)),
+                                      ('reference', by_ref, ref)):
+                match = keys.get(key)
+                if match is not None and match != MATCH_AMBIGUOUS and match not in claimed:
+                    claimed.add(match)
+                    matches.matched[row] = match
+                    matches.positions[row] = placements.at(match)
+                    counts[method] += 1
+                    if debug:
+                        log.debug('%s %s matched by %s', ref, path, method)
+                    break
+    counts['not found'] = len(index.paths) - sum(counts[method] for method in MATCH_METHODS)
+    log.info('footprints matched: %s', ', '.join(
+        '{} by {}'.format(counts[method], method) for method in MATCH_METHODS))
+    for method in MATCH_METHODS:
+        stats.count('footprints matched by ' + method, counts[method])
+    return matches
+
+# Move footprints to their computed positions, given as Placements
+# from compute_placements, using the board's FootprintIndex if it has
+# already been made. Locked footprints are left alone, and if any
+# footprints are selected only those are moved. If previous positions
+# are given (from a PlacementState), footprints whose computed
+# position is the same as last time are left alone too. With spread
+# (by default RESOLVE_OVERLAPS) footprints are then moved apart where
+# they overlap, and kept inside outline, (left, top, right, bottom), if
+# given. Footprints are matched to placements as match_footprints
+# does. Footprints already in the right place aren't touched, and the
+# rest are moved in one batch. Returns a list of (reference, path,
+# (x, y)) for the footprints that were placed.
+@stats.timed('move')
+def move_modules(placements, board, previous=None, spread=None, index=None, outline=None):
+    if spread is None:
+        spread = RESOLVE_OVERLAPS
+    if index is None:
+        index = FootprintIndex(board)
+    placed = []
+    targets = []
+    changes = []
+    not_found = skipped = 0
+    debug = log.isEnabledFor(logging.DEBUG)
+    matches = index.matches(placements)
+    for row, path in enumerate(index.paths):
+        ref = index.refs[row]
+        new_pos = matches.positions[row]
+        if new_pos is None:
+            if debug:
+                log.debug('%s %s NOT FOUND', ref, path)
+            not_found += 1
+            continue
+        if index.locked[row]:
+            if debug:
+                log.debug('%s %s is locked, skip', ref, path)
+            skipped += 1
+            continue
+        if debug:
+            log.debug('%s %s new_pos = %s', ref, path, new_pos)
+        if index.selection_active and not index.selected[row]:
+            skipped += 1
+            continue
+        if previous is not None and previous.get(path) == new_pos:
+            skipped += 1
+            continue
+        placed.append((ref, path, new_pos))
+        targets.append((row, new_pos))
+    if spread and targets:
+        with stats.phase('spread'):
+            positions = spread_footprints(board, index, targets, outline)
+        placed = [(ref, path, pos) for (ref, path, _), pos in zip(placed, positions)]
+        targets = [(row, pos) for (row, _), pos in zip(targets, positions)]
+    for row, (x, y) in targets:
+        if x != index.xs[row] or y != index.ys[row]:
+            changes.append((index.footprints[row], x, y))
+    # Check the whole batch first, so that it's never left half done.
+    low, high = BOARD_RANGE
+    for _, x, y in changes:
+        if not (low <= x <= high and low <= y <= high):
+            raise ValueError('footprints would go to ({:.3f} m, {:.3f} m), outside the +/-{:.3f} m '
+                             'a board can hold; nothing was moved'.format(x / 1e9, y / 1e9, high / 1e9))
+    board.set_positions(changes)
+    log.info('%d placed, %d moved', len(placed), len(changes))
+    stats.count('footprints', len(index.paths))
+    stats.count('footprints placed', len(placed))
+    stats.count('footprints moved', len(changes))
+    stats.count('footprints skipped', skipped)
+    stats.count('footprints not found', not_found)
+    return placed
+
+# The placement computation proper, which needs nothing from pcbnew:
+# schematic files in, placements for each component path out. It runs
+# in stages (read_sheet_files, sheet_instances, sheet_transforms,
+# component_map, compute_placements) so they can be timed separately;
+# schematic_placements runs them all.
+
+# Assemble the sheet hierarchy from the parsed files (as returned by
+# read_sheet_files), returning a map from sheet instance path ('' for
+# the root sheet) to SchSheet, in breadth-first order.
+@stats.timed('hierarchy')
+def sheet_instances(root_schematic_file, sheet_files):
+    sheets = dict()
+    sheet_queue = dict()
+    sheet_queue[''] = ('', root_schematic_file)
+    while len(sheet_queue) > 0:
+        sheet_path = list(sheet_queue)[0]
+        if sheet_path in sheets:
+            raise ValueError('sheet "{}" turned up twice'.format(sheet_path))
+        sheet_name, file_name = sheet_queue.pop(sheet_path)
+        sheet = sheet_files[sheet_file_key(file_name)]
+        log.debug('store to sheet[%s] = %s', sheet_path, file_name)
+        sheets[sheet_path] = sheet
+        for sub_sheet_name in sheet.sub_sheets:
+            sheet_queue[sheet_path + '/' + sub_sheet_name] = sheet.sub_sheets[sub_sheet_name]
+    log.info('%d unique sheet files, %d sheet instances', len(sheet_files), len(sheets))
+    stats.count('sheets', len(sheets))
+    return sheets
+
+# Find the offsets and scales to place each sheet with, arranged as
+# SHEET_LAYOUT (by default) says. Returns the offsets, as for
+# sheet_offsets, and the scale (a number, or a dict of integer scales
+# for each sheet) to pass to compute_placements. scales gives the
+# scale to draw each sheet at if not POS_SCALE; the 'hierarchy' layout
+# may draw sheets smaller.
+@stats.timed('layout')
+def sheet_transforms(sheets, layout=None, scales=None):
+    if layout is None:
+        layout = SHEET_LAYOUT
+    if layout == 'hierarchy':
+        return hierarchy_transforms(sheets, scales)
+    return sheet_offsets(sheets, layout, scales), POS_SCALE if scales is None else scales
+
+# Find coordinate offsets, as (x, y), for placement of each sub-sheet
+# in the layout, packed or stacked vertically as layout (by default
+# SHEET_LAYOUT) says. The root sheet stays where it is. If the sheets
+# are to be drawn at different scales, scales gives the scale of each;
+# the offsets are always in the sheet's own schematic units.
+def sheet_offsets(sheets, layout=None, scales=None):
+    if layout is None:
+        layout = SHEET_LAYOUT
+    if layout == 'pack':
+        return pack_sheets(sheets, scales)
+    if layout != 'vertical':
+        raise ValueError('unknown sheet layout: ' + layout)
+    scale = dict.fromkeys(sheets, 1) if scales is None else scales
+    offsets = dict()
+    offsets[''] = (0, 0)
+    running_offset = SHEET_SPACING * (sheets[''].yrange[1] - sheets[''].yrange[0]) * scale['']
+    for sname in sheets:
+        if sname == '':
+            continue
+        s = sheets[sname]
+        offsets[sname] = (0, int(running_offset / scale[sname]))
+        running_offset += SHEET_SPACING * (s.yrange[1] - s.yrange[0]) * scale[sname]
+    return offsets
+
+# The space a sheet takes up when packed: the corner of its contents
+# and the padded width and height, in its own schematic units.
+def sheet_box(sheet):
+    if sheet.xrange[0] is None:
+        return 0, 0, SHEET_MIN_SIZE, SHEET_MIN_SIZE
+    w = max(SHEET_MIN_SIZE, int(SHEET_SPACING * (sheet.xrange[1] - sheet.xrange[0])))
+    h = max(SHEET_MIN_SIZE, int(SHEET_SPACING * (sheet.yrange[1] - sheet.yrange[0])))
+    return sheet.xrange[0], sheet.yrange[0], w, h
+
+# Pack the sheets onto shelves: rows of sheets, tallest first, filled
+# left to right up to a width that makes the whole area roughly
+# square. The root sheet goes first, so it keeps its position. Sheets
+# of the same height stay in hierarchy order. With scales, the packing
+# is done at those scales.
+def pack_sheets(sheets, scales=None):
+    scale = dict.fromkeys(sheets, 1) if scales is None else scales
+    boxes = dict()
+    for path, s in sheets.items():
+        x0, y0, w, h = sheet_box(s)
+        k = scale[path]
+        boxes[path] = (x0 * k, y0 * k, w * k, h * k)
+    area = sum(w * h for _, _, w, h in boxes.values())
+    width = max(int(math.sqrt(area)), max(w for _, _, w, _ in boxes.values()))
+    origin_x, origin_y, x, shelf_h = boxes['']
+    shelf_y = 0
+    offsets = dict()
+    offsets[''] = (0, 0)
+    for path in sorted((p for p in boxes if p != ''), key=lambda p: -boxes[p][3]):
+        x0, y0, w, h = boxes[path]
+        if x + w > width:
+            shelf_y += shelf_h
+            x = shelf_h = 0
+        k = scale[path]
+        offsets[path] = ((origin_x + x - x0) // k, (origin_y + shelf_y - y0) // k)
+        x += w
+        shelf_h = max(shelf_h, h)
+    return offsets
+
+# Offsets and scales for the 'hierarchy' layout, following the sheet
+# symbols: each sheet is placed relative to its symbol on the parent
+# sheet, as fit (by default SHEET_HIERARCHY_FIT) says. A sheet's
+# transform, its scale and the board position of its origin, is worked
+# out from its parent's, which is looked up rather than recomputed, so
+# the whole hierarchy takes one pass however deep it is. Sheets with
+# no symbol information are treated as having a symbol at the parent's
+# origin.
+def hierarchy_transforms(sheets, scales=None, fit=None):
+    if fit is None:
+        fit = SHEET_HIERARCHY_FIT
+    if fit not in ('into', 'beside'):
+        raise ValueError('unknown sheet hierarchy fit: ' + fit)
+    scale = dict.fromkeys(sheets, POS_SCALE) if scales is None else scales
+    boxes = dict((path, sheet_box(s)) for path, s in sheets.items())
+
+    # The symbol of each sheet on its parent, in the parent's units.
+    blocks = dict()
+    children = defaultdict(list)
+    for path in sheets:
+        if path:
+            parent, _, sid = path.rpartition('/')
+            blocks[path] = sheets[parent].sheet_blocks.get(sid, (0, 0, 0, 0))
+            children[parent].append(path)
+
+    # Transforms as (scale, x, y): a point p on the sheet is at
+    # scale * p + (x, y) on the board.
+    transforms = dict()
+    transforms[''] = (scale[''], 0, 0)
+    if fit == 'into':
+        # Parents come before their children in sheets.
+        for path in sheets:
+            if not path:
                 continue
-            offset = offsets[sheet]
-            new_pos = pcbnew.VECTOR2I(pos[0] * POS_SCALE, (pos[1] + offset) * POS_SCALE)
-            print('  path =', path, '  sheet =', sheet, '  ref =', ref,
-                  '  pos =', pos, '  new_pos =', new_pos, file=DEBUG)
-            if not selection_active or module.IsSelected():
-                module.SetPosition(new_pos)
+            k, x, y = transforms[path.rpartition('/')[0]]
+            bx, by, bw, bh = blocks[path]
+            x0, y0, w, h = boxes[path]
+            kc = max(1, int(k * min(float(bw) / w, float(bh) / h)))
+            transforms[path] = (kc, x + k * bx + (k * bw - kc * w) // 2 - kc * x0,
+                                y + k * by + (k * bh - kc * h) // 2 - kc * y0)
+    else:
+        # Each sheet goes at (left, top) on the board, with the
+        # subtrees of its children in a column to its right, ordered
+        # by the position of their symbols. Returns the bottom of the
+        # sheet's subtree.
+        def place(path, left, top):
+            k = scale[path]
+            x0, y0, w, h = boxes[path]
+            transforms[path] = (k, left - k * x0, top - k * y0)
+            bottom = top + k * h
+            cursor = top
+            for child in sorted(children[path], key=lambda c: (blocks[c][1], blocks[c][0])):
+                cursor = place(child, left + k * w,
+                               max(cursor, top + k * (blocks[child][1] - y0)))
+            return max(bottom, cursor)
+
+        k, x0, y0, _, _ = (scale[''],) + boxes['']
+        place('', k * x0, k * y0)
+
+    offsets = dict()
+    scales = dict()
+    for path, (k, x, y) in transforms.items():
+        offsets[path] = (int(round(float(x) / k)), int(round(float(y) / k)))
+        scales[path] = k
+    return offsets, scales
+
+# Compact store of the components of every sheet instance, one row
+# per component instance. Sheet instance paths are interned as small
+# integer IDs; positions and sheet IDs are array columns, and
+# references and component IDs stay in the (shared) SchSheet they came
+# from. The rows for a sheet instance are contiguous, starting at
+# base[sheet ID], so a footprint path is resolved to a row through the
+# sheet's own component ID -> row map, with no per-instance dict or
+# path strings.
+class ComponentStore:
+    def __init__(self, sheets):
+        self.sheet_paths = list(sheets)
+        self.sheet_ids = dict(zip(self.sheet_paths, range(len(self.sheet_paths))))
+        self.sheets = [sheets[path] for path in self.sheet_paths]
+        self.base = array('l')
+        self.xs = array('i')
+        self.ys = array('i')
+        self.sheet = array('i')
+        for sid, s in enumerate(self.sheets):
+            self.base.append(len(self.xs))
+            self.xs.extend(s.xs)
+            self.ys.extend(s.ys)
+            self.sheet.extend(array('i', [sid]) * len(s.xs))
+
+    def __len__(self):
+        return len(self.xs)
+
+    # Row for a footprint path, or None if there's no such component.
+    def row(self, path):
+        sheet_path, _, cid = path.rpartition('/')
+        sid = self.sheet_ids.get(sheet_path)
+        if sid is None:
+            return None
+        local = self.sheets[sid].component_rows.get(cid)
+        if local is None:
+            return None
+        return self.base[sid] + local
+
+    def ref(self, row):
+        sid = self.sheet[row]
+        return self.sheets[sid].refs[row - self.base[sid]]
+
+    def path(self, row):
+        sid = self.sheet[row]
+        return self.sheet_paths[sid] + '/' + self.sheets[sid].component_ids[row - self.base[sid]]
+
+    # Approximate memory used by the store's own columns and indexes
+    # (the SchSheets it refers to are shared, so aren't counted).
+    def nbytes(self):
+        return (sys.getsizeof(self.sheet_paths) + sys.getsizeof(self.sheet_ids) +
+                sum(sys.getsizeof(p) for p in self.sheet_paths) +
+                sum(sys.getsizeof(a) for a in (self.base, self.xs, self.ys, self.sheet)))
+
+    # Board positions for every row: each sheet is shifted by its
+    # offset and scaled, by scale or, if it's a dict, by the integer
+    # scale it gives for the sheet, as one vectorised operation (with
+    # numpy if it's available). Returns (xs, ys) columns.
+    def transform(self, offsets, scale=POS_SCALE):
+        offset_xs = [offsets[path][0] for path in self.sheet_paths]
+        offset_ys = [offsets[path][1] for path in self.sheet_paths]
+        if isinstance(scale, dict):
+            scales = [scale[path] for path in self.sheet_paths]
         else:
-            print('  NOT FOUND', file=DEBUG)
+            scales = [scale] * len(self.sheet_paths)
+        if numpy is not None and len(self.xs):
+            sheet = numpy.frombuffer(self.sheet, dtype=numpy.int32)
+            xs = numpy.frombuffer(self.xs, dtype=numpy.int32).astype(numpy.int64)
+            ys = numpy.frombuffer(self.ys, dtype=numpy.int32).astype(numpy.int64)
+            sheet_scales = numpy.array(scales, dtype=numpy.int64)[sheet]
+            xs = (xs + numpy.array(offset_xs, dtype=numpy.int64)[sheet]) * sheet_scales
+            ys = (ys + numpy.array(offset_ys, dtype=numpy.int64)[sheet]) * sheet_scales
+            return xs, ys
+        xs = array('q', [(x + offset_xs[s]) * scales[s] for x, s in zip(self.xs, self.sheet)])
+        ys = array('q', [(y + offset_ys[s]) * scales[s] for y, s in zip(self.ys, self.sheet)])
+        return xs, ys
+
+# Make a master component map, recording the components' positions in
+# each sheet instance.
+@stats.timed('component map')
+def component_map(sheets):
+    components = ComponentStore(sheets)
+    log.info('%d components in %d sheet instances, %d bytes',
+             len(components), len(sheets), components.nbytes())
+    if log.isEnabledFor(logging.DEBUG):
+        for row in range(len(components)):
+            log.debug('%s %s (%d, %d) %s', components.path(row), components.ref(row),
+                      components.xs[row], components.ys[row],
+                      components.sheet_paths[components.sheet[row]])
+    stats.count('symbols', len(components))
+    return components
+
+# Board positions for the components in a ComponentStore, as columns
+# parallel to the store's rows, along with the sheet offsets and scale
+# they were worked out from. Iterating gives (path, x, y) tuples.
+class Placements:
+    def __init__(self, components, xs, ys, offsets=None, scale=POS_SCALE):
+        self.components = components
+        self.xs = xs
+        self.ys = ys
+        self.offsets = offsets
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __iter__(self):
+        for row in range(len(self.xs)):
+            yield self.components.path(row), int(self.xs[row]), int(self.ys[row])
+
+    # Position for a footprint path, or None.
+    def get(self, path):
+        row = self.components.row(path)
+        if row is None:
+            return None
+        return (int(self.xs[row]), int(self.ys[row]))
+
+    def row(self, path):
+        return self.components.row(path)
+
+    def at(self, row):
+        return (int(self.xs[row]), int(self.ys[row]))
+
+    # (row, sheet path, component ID, reference) for every row.
+    def entries(self):
+        components = self.components
+        for sid, sheet in enumerate(components.sheets):
+            sheet_path = components.sheet_paths[sid]
+            base = components.base[sid]
+            for local, (cid, ref) in enumerate(zip(sheet.component_ids, sheet.refs)):
+                yield base + local, sheet_path, cid, ref
+
+# Scale schematic positions to board positions, offsetting each sheet
+# into its own area.
+@stats.timed('placements')
+def compute_placements(components, offsets, scale=POS_SCALE):
+    xs, ys = components.transform(offsets, scale)
+    return Placements(components, xs, ys, offsets, scale)
+
+# Scales for each sheet of placements (for AUTO_SCALE), from the
+# footprints on a board: a sheet's scale is the one at which the
+# courtyards of its footprints cover AUTO_SCALE_FILL of its area. Sheets
+# with no footprints or no area keep POS_SCALE. Footprints belong to
+# the sheets of the symbols they are matched to, however they were
+# matched (see match_footprints). The courtyard areas are summed per
+# sheet, and the scales worked out, for all sheets at once.
+def sheet_scales(placements, board, index):
+    components = placements.components
+    nsheets = len(components.sheet_paths)
+    sheet_ids = []
+    areas = []
+    matched = index.matches(placements).matched
+    for row, (left, top, right, bottom) in zip(matched, index.extents(board)):
+        if row is not None:
+            sheet_ids.append(components.sheet[row])
+            areas.append(float(right - left) * (bottom - top))
+    spans = [float(s.xrange[1] - s.xrange[0]) * (s.yrange[1] - s.yrange[0])
+             if s.xrange[0] is not None else 0.0 for s in components.sheets]
+    if numpy is not None:
+        area = numpy.bincount(numpy.array(sheet_ids, dtype=numpy.int64),
+                              weights=numpy.array(areas), minlength=nsheets)
+        span = numpy.array(spans)
+        valid = (area > 0) & (span > 0)
+        scale = numpy.full(nsheets, float(POS_SCALE))
+        scale[valid] = numpy.sqrt(area[valid] / (AUTO_SCALE_FILL * span[valid]))
+        scales = [max(1, int(k)) for k in scale]
+    else:
+        area = [0.0] * nsheets
+        for sid, a in zip(sheet_ids, areas):
+            area[sid] += a
+        scales = [max(1, int(math.sqrt(a / (AUTO_SCALE_FILL * sp)))) if a > 0 and sp > 0 else POS_SCALE
+                  for a, sp in zip(area, spans)]
+    return dict(zip(components.sheet_paths, scales))
+
+# Shrink placements if need be so that the courtyards of the
+# footprints on the board (a FootprintIndex of it) fit inside outline,
+# (left, top, right, bottom), and move them into it. Only the positions
+# are scaled, not the footprints, so the positions are fitted into the
+# outline less the largest courtyard on each side; the courtyards then
+# go from the top left corner. If no footprints match, the positions
+# themselves are fitted.
+def fit_placements(placements, outline, board, index):
+    xs, ys = placements.xs, placements.ys
+    if not len(xs):
+        return placements
+    rows = []
+    extents = []
+    for row, extent in zip(index.matches(placements).matched, index.extents(board)):
+        if row is not None:
+            rows.append(row)
+            extents.append(extent)
+    if not rows:
+        rows = range(len(xs))
+        extents = [(0, 0, 0, 0)] * len(xs)
+    px = [int(xs[row]) for row in rows]
+    py = [int(ys[row]) for row in rows]
+    left, top = min(px), min(py)
+    width, height = max(px) - left, max(py) - top
+    room_x = (outline[2] - outline[0]) - (max(e[2] for e in extents) - min(e[0] for e in extents))
+    room_y = (outline[3] - outline[1]) - (max(e[3] for e in extents) - min(e[1] for e in extents))
+    if room_x < 0 or room_y < 0:
+        log.warning('footprints too big for the board outline')
+    factor = 1.0
+    if width > 0:
+        factor = min(factor, float(max(0, room_x)) / width)
+    if height > 0:
+        factor = min(factor, float(max(0, room_y)) / height)
+    shift_x = outline[0] - min(int((x - left) * factor) + e[0] for x, e in zip(px, extents))
+    shift_y = outline[1] - min(int((y - top) * factor) + e[1] for y, e in zip(py, extents))
+    if numpy is not None:
+        xs = ((numpy.asarray(xs) - left) * factor).astype(numpy.int64) + shift_x
+        ys = ((numpy.asarray(ys) - top) * factor).astype(numpy.int64) + shift_y
+    else:
+        xs = array('q', [int((x - left) * factor) + shift_x for x in xs])
+        ys = array('q', [int((y - top) * factor) + shift_y for y in ys])
+    return Placements(placements.components, xs, ys, placements.offsets, placements.scale)
+
+# Placements worked out again with scales to suit the footprints on
+# the board (for AUTO_SCALE): the sheets are laid out at their own
+# scales, and then fitted to outline (as fit_placements does), if
+# given.
+@stats.timed('auto scale')
+def auto_scale_placements(placements, board, index, outline=None):
+    components = placements.components
+    scales = sheet_scales(placements, board, index)
+    log.info('auto scale: %d to %d', min(scales.values()), max(scales.values()))
+    sheets = dict(zip(components.sheet_paths, components.sheets))
+    placements = compute_placements(components, *sheet_transforms(sheets, None, scales))
+    if outline is not None:
+        placements = fit_placements(placements, outline, board, index)
+    return placements
+
+# Compute placements for a whole schematic hierarchy.
+def schematic_placements(root_schematic_file, cache=None, parse_workers=None):
+    sheet_files = read_sheet_files(root_schematic_file, cache, parse_workers)
+    sheets = sheet_instances(root_schematic_file, sheet_files)
+    return compute_placements(component_map(sheets), *sheet_transforms(sheets))
+
+
+# Size and modification time of a file, or None if it has gone.
+def file_stamp(file_name):
+    try:
+        st = os.stat(file_name)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+# Keeps the placements for a schematic hierarchy up to date, for watch
+# mode. The sheet files found when the hierarchy was last read are
+# polled from a background thread; once they have changed and then
+# been left alone for WATCH_DEBOUNCE seconds, the changed files are
+# parsed again, the other sheets are reused, and the placements are
+# recomputed. generation counts those updates. Sheet file names are
+# relative to the board's directory, so updates are only made in the
+# background while that's the current directory; current() brings
+# the placements up to date on demand.
+class SchematicWatcher:
+    def __init__(self, root_schematic_file, cache=None, parse_workers=None):
+        self.root_schematic_file = root_schematic_file
+        self.work_dir = os.getcwd()
+        self.cache = cache
+        self.parse_workers = parse_workers
+        self.lock = threading.RLock()
+        self.sheet_files = dict()
+        self.stamps = dict()
+        self.placements = None
+        self.generation = 0
+        self.seen = None
+        self.changed_at = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.stats = RunStats()
+        self.refresh()
+
+    # Stamps of the sheet files read last time.
+    def current_stamps(self):
+        return dict((key, file_stamp(key)) for key in self.stamps)
+
+    # Read the changed sheet files and recompute the placements. The
+    # stamps are taken before reading, so a file saved while it is
+    # being read is read again next time.
+    def refresh(self):
+        with self.lock:
+            stamps = self.current_stamps()
+            known = dict()
+            for key, sheet in self.sheet_files.items():
+                if stamps[key] is not None and stamps[key] == self.stamps[key]:
+                    known[key] = sheet
+            sheet_files = read_sheet_files(self.root_schematic_file, self.cache,
+                                           self.parse_workers, known)
+            sheets = sheet_instances(self.root_schematic_file, sheet_files)
+            self.placements = compute_placements(component_map(sheets), *sheet_transforms(sheets))
+            log.info('watch: %d of %d sheet files read', len(sheet_files) - len(known), len(sheet_files))
+            self.sheet_files = sheet_files
+            self.stamps = dict((key, stamps[key] if key in stamps else file_stamp(key))
+                               for key in sheet_files)
+            self.seen = None
+            self.generation += 1
+            if self.cache is not None:
+                self.cache.save()
+
+    # Check for changes, refreshing once they have settled. Returns
+    # True if the placements were updated.
+    def poll(self):
+        with self.lock:
+            stamps = self.current_stamps()
+            if stamps == self.stamps:
+                self.seen = None
+                return False
+            now = time.monotonic()
+            if stamps != self.seen:
+                self.seen = stamps
+                self.changed_at = now
+                return False
+            if now - self.changed_at < WATCH_DEBOUNCE or os.getcwd() != self.work_dir:
+                return False
+            self.refresh()
+            return True
+
+    # Up to date placements, reading any changed files first.
+    def current(self):
+        with self.lock:
+            if self.current_stamps() != self.stamps:
+                self.refresh()
+            return self.placements
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='SchematicWatcher')
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Updates made in the background are recorded to the watcher's own
+    # stats, not to those of whatever run is going on at the time.
+    def run(self):
+        stats.use(self.stats)
+        while not self.stopped.wait(WATCH_INTERVAL):
+            try:
+                self.poll()
+            except Exception as err:
+                log.warning('watch: failed reading %s: %s', self.root_schematic_file, err)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+# Running watchers, by root schematic file key.
+watchers = dict()
+
+# The watcher for a root schematic, started the first time it's asked
+# for, in the board's directory work_dir.
+def schematic_watcher(root_schematic_file, work_dir, parse_workers=None):
+    key = sheet_file_key(root_schematic_file)
+    watcher = watchers.get(key)
+    if watcher is None:
+        cache = SheetCache(os.path.join(work_dir, PARSE_CACHE_FILE)) if PARSE_CACHE else None
+        watcher = SchematicWatcher(root_schematic_file, cache, parse_workers)
+        watcher.start()
+        watchers[key] = watcher
+    return watcher
+
+
+# Positions footprints were placed at by earlier runs, for incremental
+# mode, keyed by footprint path. Because the placed position is worked
+# out from the schematic position, the sheet offset and the scale, a
+# change to any of them shows up as a different position. A state
+# file for another board or in an old format is ignored.
+class PlacementState:
+    def __init__(self, path, board_name):
+        self.path = path
+        self.board_name = board_name
+        self.positions = dict()
+        try:
+            with open(path, encoding='utf-8') as fp:
+                state = json.load(fp)
+            if state['version'] == PLACEMENT_STATE_VERSION and state['board'] == board_name:
+                for fp_path, pos in state['positions'].items():
+                    self.positions[fp_path] = tuple(pos)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    # Record what was placed by this run, dropping footprints that
+    # are no longer in the schematic. The computed positions are kept,
+    # before any overlaps were resolved. placements is anything that
+    # looks up the position for a footprint path, such as
+    # FootprintMatches.
+    def update(self, placements, placed):
+        positions = dict()
+        for fp_path, pos in self.positions.items():
+            if placements.get(fp_path) is not None:
+                positions[fp_path] = pos
+        for ref, fp_path, _ in placed:
+            positions[fp_path] = placements.get(fp_path)
+        self.positions = positions
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as fp:
+                json.dump({'version': PLACEMENT_STATE_VERSION, 'board': self.board_name,
+                           'positions': self.positions}, fp, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except OSError as err:
+            log.warning('Failed writing placement state: %s', err)
 
 
-class SchematicPositionsToLayoutPlugin(pcbnew.ActionPlugin):
+# Placement files hold the placements worked out for a board, so they
+# can be replayed without the schematic. They are little-endian and
+# laid out so that a memory map of the file can be used in place: a
+# header, then int32 columns, then a string table, each starting on a
+# 4-byte boundary.
+#
+#   header   magic, then version, number of sheets, rows and strings,
+#            string table size in bytes and a reserved 0 (uint32)
+#   strings  n_strings + 1 offsets into the string table
+#   sheets   path (string number), offset x, offset y, scale, one
+#            column of n_sheets each; offsets are in the sheet's own
+#            units, as sheet_transforms gives them
+#   rows     sheet number, component ID and reference (string numbers),
+#            x and y (in nm), one column of n_rows each
+#   table    the strings, UTF-8 encoded and each followed by a 0
+#            byte, each stored once
+#
+# A footprint's path is its sheet's path, '/' and its component ID.
+PLACEMENT_HEADER = struct.Struct('<8s6I')
+PLACEMENT_COLUMNS = (('string_offsets', 'strings', 1), ('sheet_path', 'sheets', 0),
+                     ('sheet_x', 'sheets', 0), ('sheet_y', 'sheets', 0),
+                     ('sheet_scale', 'sheets', 0), ('row_sheet', 'rows', 0),
+                     ('row_id', 'rows', 0), ('row_ref', 'rows', 0),
+                     ('row_x', 'rows', 0), ('row_y', 'rows', 0))
+
+# Lowest and highest value a placement file column can hold: positions
+# are stored as 32-bit integers, in nm as on a KiCad board.
+PLACEMENT_FILE_RANGE = BOARD_RANGE
+
+# Raise ValueError if values (positions in nm) can't be stored in a
+# placement file, naming what they are.
+def check_placement_range(name, values):
+    if not len(values):
+        return
+    low, high = int(min(values)), int(max(values))
+    if low < PLACEMENT_FILE_RANGE[0] or high > PLACEMENT_FILE_RANGE[1]:
+        raise ValueError('{} runs from {:.3f} m to {:.3f} m, beyond the +/-{:.3f} m a '
+                         'placement file can hold'.format(name, low / 1e9, high / 1e9,
+                                                          PLACEMENT_FILE_RANGE[1] / 1e9))
+
+# Save Placements to a placement file. Raises ValueError, before
+# writing anything, if the placements are too far out to be stored.
+@stats.timed('export')
+def write_placement_file(file_name, placements):
+    components = placements.components
+    # Sheet offsets are in schematic units, a scale's worth smaller than
+    # the positions, so only the positions need checking.
+    check_placement_range('placement x', placements.xs)
+    check_placement_range('placement y', placements.ys)
+    strings = []
+    string_ids = dict()
+
+    def intern(text):
+        sid = string_ids.get(text)
+        if sid is None:
+            sid = string_ids[text] = len(strings)
+            strings.append(text.encode('utf-8') + b'\0')
+        return sid
+
+    columns = dict((name, array('i')) for name, _, _ in PLACEMENT_COLUMNS)
+    scale = placements.scale
+    for path, sheet in zip(components.sheet_paths, components.sheets):
+        columns['sheet_path'].append(intern(path))
+        x, y = placements.offsets[path] if placements.offsets is not None else (0, 0)
+        columns['sheet_x'].append(x)
+        columns['sheet_y'].append(y)
+        columns['sheet_scale'].append(scale[path] if isinstance(scale, dict) else scale)
+    # Sheet files used more than once share their strings.
+    sheet_strings = dict()
+    for sid, sheet in enumerate(components.sheets):
+        ids_refs = sheet_strings.get(id(sheet))
+        if ids_refs is None:
+            ids_refs = sheet_strings[id(sheet)] = (
+                array('i', [intern(cid) for cid in sheet.component_ids]),
+                array('i', [intern(ref) for ref in sheet.refs]))
+        columns['row_sheet'].extend(array('i', [sid]) * len(sheet.component_ids))
+        columns['row_id'].extend(ids_refs[0])
+        columns['row_ref'].extend(ids_refs[1])
+    columns['row_x'] = array('i', placements.xs)
+    columns['row_y'] = array('i', placements.ys)
+    offset = 0
+    columns['string_offsets'].append(0)
+    for text in strings:
+        offset += len(text)
+        columns['string_offsets'].append(offset)
+    table = b''.join(strings)
+    table += b'\0' * (-len(table) % 4)
+
+    header = PLACEMENT_HEADER.pack(PLACEMENT_FILE_MAGIC, PLACEMENT_FILE_VERSION,
+                                   len(components.sheets), len(components),
+                                   len(strings), len(table), 0)
+    tmp = file_name + '.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(header)
+        for name, _, _ in PLACEMENT_COLUMNS:
+            column = columns[name]
+            if sys.byteorder == 'big':
+                column.byteswap()
+            fp.write(column.tobytes())
+        fp.write(table)
+    os.replace(tmp, file_name)
+    log.info('%d placements saved to %s', len(components), file_name)
+
+# Placements read from a placement file, memory-mapped where possible
+# and used in place. It can stand in for Placements in move_modules:
+# get() looks up a footprint path and iterating gives (path, x, y).
+# Raises ValueError if the file isn't a placement file this version
+# can read. Close it (or use it in a with statement) when done.
+class PlacementFile:
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as fp:
+            self.data = map_file(fp)
+        try:
+            magic, version, n_sheets, n_rows, n_strings, table_size, _ = \
+                PLACEMENT_HEADER.unpack_from(self.data)
+        except struct.error:
+            magic = version = None
+        if magic != PLACEMENT_FILE_MAGIC:
+            self.close()
+            raise ValueError('{} is not a placement file'.format(file_name))
+        if version != PLACEMENT_FILE_VERSION:
+            self.close()
+            raise ValueError('{} is placement file version {}, not {}'.format(
+                file_name, version, PLACEMENT_FILE_VERSION))
+        counts = dict(sheets=n_sheets, rows=n_rows, strings=n_strings)
+        size = PLACEMENT_HEADER.size + 4 * sum(counts[count] + extra
+                                               for _, count, extra in PLACEMENT_COLUMNS)
+        if len(self.data) < size + table_size:
+            self.close()
+            raise ValueError('{} is truncated'.format(file_name))
+        self.view = memoryview(self.data)
+        pos = PLACEMENT_HEADER.size
+        for name, count, extra in PLACEMENT_COLUMNS:
+            end = pos + 4 * (counts[count] + extra)
+            if sys.byteorder == 'big':
+                column = array('i', self.view[pos:end])
+                column.byteswap()
+            else:
+                column = self.view[pos:end].cast('i')
+            setattr(self, name, column)
+            pos = end
+        self.table = self.view[pos:pos + table_size]
+        self.sheet_paths = [self.string(sid) for sid in self.sheet_path]
+        self.offsets = dict((path, (x, y)) for path, x, y
+                            in zip(self.sheet_paths, self.sheet_x, self.sheet_y))
+        self.scales = dict(zip(self.sheet_paths, self.sheet_scale))
+        self.rows = None
+
+    def string(self, sid):
+        return bytes(self.table[self.string_offsets[sid]:self.string_offsets[sid + 1] - 1]).decode('utf-8')
+
+    def __len__(self):
+        return len(self.row_x)
+
+    def ref(self, row):
+        return self.string(self.row_ref[row])
+
+    def path(self, row):
+        return self.sheet_paths[self.row_sheet[row]] + '/' + self.string(self.row_id[row])
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.path(row), self.row_x[row], self.row_y[row]
+
+    # All the strings, decoded at once.
+    def strings(self):
+        return bytes(self.table[:self.string_offsets[-1]]).decode('utf-8').split('\0')
+
+    # Position for a footprint path, or None. The paths are indexed
+    # the first time this is called.
+    def get(self, path):
+        row = self.row(path)
+        if row is None:
+            return None
+        return (self.row_x[row], self.row_y[row])
+
+    def row(self, path):
+        if self.rows is None:
+            ids = self.strings()
+            paths, row_id = self.sheet_paths, self.row_id
+            self.rows = dict((paths[sid] + '/' + ids[row_id[row]], row)
+                             for row, sid in enumerate(self.row_sheet))
+        return self.rows.get(path)
+
+    def at(self, row):
+        return (self.row_x[row], self.row_y[row])
+
+    # (row, sheet path, component ID, reference) for every row.
+    def entries(self):
+        strings = self.strings()
+        paths = self.sheet_paths
+        for row, (sid, cid, ref) in enumerate(zip(self.row_sheet, self.row_id, self.row_ref)):
+            yield row, paths[sid], strings[cid], strings[ref]
+
+    def close(self):
+        for name, _, _ in PLACEMENT_COLUMNS:
+            if hasattr(self, name):
+                column = getattr(self, name)
+                if isinstance(column, memoryview):
+                    column.release()
+        if hasattr(self, 'view'):
+            self.table.release()
+            self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+# Write a placement file out as text, one line per sheet and then one
+# per footprint (path, reference and position in mm), sorted so that
+# two files can be compared with diff.
+def dump_placement_file(file_name, out=None):
+    out = out or sys.stdout
+    with PlacementFile(file_name) as saved:
+        print('placement file version {}: {} sheets, {} footprints'.format(
+            PLACEMENT_FILE_VERSION, len(saved.sheet_paths), len(saved)), file=out)
+        for path in sorted(saved.sheet_paths):
+            x, y = saved.offsets[path]
+            print('sheet {} offset {} {} scale {}'.format(path or '/', x, y, saved.scales[path]),
+                  file=out)
+        for path, ref, x, y in sorted((saved.path(row), saved.ref(row), saved.row_x[row],
+                                       saved.row_y[row]) for row in range(len(saved))):
+            print('{} {} {:.6f} {:.6f}'.format(path, ref, x / 1e6, y / 1e6), file=out)
+
+
+# Placements shrunk if need be so that the footprints on the board (a
+# FootprintIndex of it) all land within BOARD_RANGE, as they may not
+# with a big hierarchy drawn at full scale. The layout is then fitted
+# into the positive quarter of the range, where schematics are, as
+# fit_placements does. Returns the placements and the area they were
+# fitted into, or None if they were left alone.
+def fit_board_range(placements, board, index):
+    positions = [pos for pos in index.matches(placements).positions if pos is not None]
+    if not positions:
+        return placements, None
+    left = min(x for x, _ in positions)
+    right = max(x for x, _ in positions)
+    top = min(y for _, y in positions)
+    bottom = max(y for _, y in positions)
+    low, high = BOARD_RANGE
+    if low <= left and right <= high and low <= top and bottom <= high:
+        return placements, None
+    log.warning('the layout is %.1f m by %.1f m, too big for a board; shrinking it to fit',
+                (right - left) / 1e9, (bottom - top) / 1e9)
+    area = (0, 0, high, high)
+    return fit_placements(placements, area, board, index), area
+
+# Lay out the footprints on a board (a board adapter) in the same
+# pattern as the components on its schematic, returning what was
+# placed (as for move_modules). This is the body of the plugin, kept
+# separate from it so that it can also be run on a board loaded
+# outside the Pcbnew GUI. The root schematic defaults to the one named
+# after the board, incremental and watch mode to INCREMENTAL and
+# WATCH, spread to RESOLVE_OVERLAPS and auto_scale to AUTO_SCALE. A
+# layout too big for a board is shrunk to fit (see fit_board_range).
+# Given saved placements (a PlacementFile) they are replayed instead,
+# without reading the schematic. Given export, the placements are
+# saved to that placement file (by default PLACEMENT_FILE, if
+# PLACEMENT_EXPORT is set).
+def place_board(board, root_schematic_file=None, parse_workers=None,
+                incremental=None, watch=None, spread=None, auto_scale=None,
+                saved=None, export=None):
+    if incremental is None:
+        incremental = INCREMENTAL
+    if watch is None:
+        watch = WATCH
+    if auto_scale is None:
+        auto_scale = AUTO_SCALE
+    if export is None and PLACEMENT_EXPORT:
+        export = PLACEMENT_FILE
+    work_dir, in_pcb_file = os.path.split(board.file_name())
+    os.chdir(work_dir)
+    if root_schematic_file is None:
+        root_schematic_file = os.path.splitext(in_pcb_file)[0] + '.kicad_sch'
+    root_schematic_file = str(root_schematic_file) # 对Unicode中文的支持 (support for Chinese Unicode)
+    log.debug('work_dir = %s', work_dir)
+    log.debug('in_pcb_file = %s', in_pcb_file)
+    log.debug('root_schematic_file = %s', root_schematic_file)
+
+    # Read schematic sheets, starting at root sheet and following
+    # links to sub-sheets, and work out where everything goes. In
+    # watch mode that's already been done, unless something changed.
+    if saved is not None:
+        placements = saved
+    elif watch:
+        placements = schematic_watcher(root_schematic_file, work_dir, parse_workers).current()
+    else:
+        cache = SheetCache(os.path.join(work_dir, PARSE_CACHE_FILE)) if PARSE_CACHE else None
+        placements = schematic_placements(root_schematic_file, cache, parse_workers)
+        if cache is not None:
+            log.info('parse cache: %d hits, %d misses', cache.hits, cache.misses)
+            cache.save()
+
+    # Move the components, with the scale fitted to the footprints if
+    # auto scaling, from one snapshot of the board.
+    # When the layout is fitted to the board outline, footprints
+    # spread apart are kept inside it too.
+    with stats.phase('board index'):
+        index = FootprintIndex(board)
+    outline = None
+    if saved is None:
+        if auto_scale:
+            outline = board.outline() if AUTO_SCALE_OUTLINE else None
+            placements = auto_scale_placements(placements, board, index, outline)
+        placements, area = fit_board_range(placements, board, index)
+        if area is not None and outline is None:
+            outline = area
+        if export is not None:
+            write_placement_file(export, placements)
+    if not incremental:
+        return move_modules(placements, board, None, spread, index, outline)
+    state = PlacementState(os.path.join(work_dir, PLACEMENT_STATE_FILE), in_pcb_file)
+    placed = move_modules(placements, board, state.positions, spread, index, outline)
+    log.info('incremental: %d of %d footprints placed', len(placed), len(placements))
+    with stats.phase('state'):
+        state.update(index.matches(placements), placed)
+        state.save()
+    return placed
+
+
+# Set up logging for one run, writing to LOG_FILE in work_dir if
+# verbose (by default, if VERBOSE is set). Returns the handler to pass
+# to stop_log afterwards.
+def start_log(work_dir, verbose=None):
+    if verbose is None:
+        verbose = VERBOSE
+    if not verbose:
+        log.setLevel(logging.WARNING)
+        return None
+    file_name = os.path.join(work_dir, LOG_FILE)
+    if LOG_MAX_BYTES:
+        target = logging.handlers.RotatingFileHandler(
+            file_name, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    else:
+        target = logging.FileHandler(file_name, 'w', encoding='utf-8')
+    target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    handler = logging.handlers.MemoryHandler(LOG_BUFFER, logging.ERROR, target)
+    log.setLevel(LOG_LEVEL)
+    log.addHandler(handler)
+    return handler
+
+# Flush and close the log set up by start_log.
+def stop_log(handler):
+    if handler is None:
+        return
+    target = handler.target
+    log.removeHandler(handler)
+    handler.close()
+    target.close()
+
+# Start collecting statistics for one run on a board, reporting them
+# next to it if enabled (by default, if STATS is set) and profiling
+# the run if profile (STATS_PROFILE) is set. Returns what to pass to
+# stop_stats afterwards.
+def start_stats(board_file, enabled=None, profile=None):
+    if enabled is None:
+        enabled = STATS
+    if profile is None:
+        profile = STATS_PROFILE
+    stats.reset()
+    if not enabled:
+        return None
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return (board_file, time.time(), time.perf_counter(), time.process_time(), profiler)
+
+# The functions with the most cumulative time in a profile, as dicts.
+def profile_top(profiler, n=STATS_PROFILE_TOP):
+    import pstats
+    entries = pstats.Stats(profiler).stats
+    top = sorted(entries.items(), key=lambda item: -item[1][3])[:n]
+    return [{'function': '{}:{}({})'.format(os.path.basename(file), line, name),
+             'calls': nc, 'tottime': tt, 'cumtime': ct}
+            for (file, line, name), (cc, nc, tt, ct, callers) in top]
+
+# Finish the run started by start_stats, appending its report to
+# STATS_FILE (and saving the profile) next to the board.
+def stop_stats(run):
+    if run is None:
+        return
+    board_file, started, wall, cpu, profiler = run
+    report = {'version': STATS_VERSION,
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+              'board': board_file,
+              'kicad': pcbnew.GetBuildVersion() if pcbnew is not None else None,
+              'python': platform.python_version(),
+              'wall': time.perf_counter() - wall,
+              'cpu': time.process_time() - cpu}
+    report.update(stats.report())
+    work_dir = os.path.dirname(os.path.abspath(board_file))
+    try:
+        if profiler is not None:
+            profiler.disable()
+            profile_file = os.path.join(work_dir, STATS_PROFILE_FILE)
+            profiler.dump_stats(profile_file)
+            report['profile'] = {'file': profile_file, 'top': profile_top(profiler)}
+        with open(os.path.join(work_dir, STATS_FILE), 'a', encoding='utf-8') as fp:
+            print(json.dumps(report, sort_keys=True), file=fp)
+    except OSError as err:
+        log.warning('Failed writing run statistics: %s', err)
+
+
+class SchematicPositionsToLayoutPlugin(pcbnew.ActionPlugin if pcbnew is not None else object):
     def defaults(self):
         self.name = "Schematic positions -> PCB positions"
         self.category = "Modify PCB"
@@ -173,73 +2043,190 @@ class SchematicPositionsToLayoutPlugin(pcbnew.ActionPlugin):
         self.show_toolbar_button = True # Optional, defaults to False
         self.icon_file_name = os.path.join(os.path.dirname(__file__), 'sch2layout.png') # Optional, defaults to ""
     def Run(self):
-        global DEBUG
-        work_dir = os.path.dirname(pcbnew.GetBoard().GetFileName())
-        DEBUG = open(os.path.join(work_dir, 'schematic-positions-to-layout.debug'), 'w')
+        board_file = pcbnew.GetBoard().GetFileName()
+        handler = start_log(os.path.dirname(board_file))
+        run = start_stats(board_file)
         try:
             self.DoRun()
         finally:
-            DEBUG.close()
+            stop_stats(run)
+            stop_log(handler)
 
     def DoRun(self):
-        board = pcbnew.GetBoard()
-        work_dir, in_pcb_file = os.path.split(board.GetFileName())
-        os.chdir(work_dir)
-        root_schematic_file = os.path.splitext(in_pcb_file)[0] + '.kicad_sch'
-        root_schematic_file = str(root_schematic_file) # 对Unicode中文的支持 (support for Chinese Unicode)
-        print('work_dir = {}'.format(work_dir), file=DEBUG)
-        print('in_pcb_file = {}'.format(in_pcb_file), file=DEBUG)
-        print('root_schematic_file = {}'.format(root_schematic_file), file=DEBUG)
-
-        # Read schematic sheets, starting at root sheet and following
-        # links to sub-sheets.
-        sheets = dict()
-        sheet_queue = dict()
-        sheet_queue[''] = ('', root_schematic_file)
-        while len(sheet_queue) > 0:
-            sheet_path = list(sheet_queue)[0]
-            if sheet_path in sheets:
-                print('Oops. Sheet "{}" turned up twice!'.format(sheet_path), file=DEBUG)
-                sys.exit(1)
-            sheet_name, file_name = sheet_queue.pop(sheet_path)
-            sheet = SchSheet(file_name)
-            print('store to sheet[{}] = {}'.format(sheet_path, file_name), file=DEBUG)
-            sheets[sheet_path] = sheet
-            for sub_sheet_name in sheet.sub_sheets:
-                sheet_queue[sheet_path + '/' + sub_sheet_name] = sheet.sub_sheets[sub_sheet_name]
-
-        # Find coordinate offsets for placement of each sub-sheet in
-        # the layout.
-        offsets = dict()
-        offsets[''] = 0
-        OFFSET_FACTOR = 1.25
-        running_offset = OFFSET_FACTOR * (sheets[''].yrange[1] - sheets[''].yrange[0])
-        for sname in sheets:
-            if sname == '':
-                continue
-            s = sheets[sname]
-            offsets[sname] = int(running_offset)
-            running_offset += OFFSET_FACTOR * (s.yrange[1] - s.yrange[0])
-
-        # Make a master component map, recording the component's
-        # position in the sheet.
-        components = dict()
-        s = sheets['']
-        for cid in s.components:
-            components['/' + cid] = s.components[cid] + tuple([''])
-        for sheet_name in sheets:
-            if sheet_name == '':
-                continue
-            print('Processing', sheet_name, file=DEBUG)
-            s = sheets[sheet_name]
-            for cid in s.components:
-                components[sheet_name + '/' + cid] = s.components[cid] + tuple([sheet_name])
+        place_board(PcbnewBoard(pcbnew.GetBoard()))
+        with stats.phase('refresh'):
+            pcbnew.Refresh()
+
+
+# Write footprint positions from move_modules to a CSV file, in mm.
+def write_placements(file_name, placed):
+    with open(file_name, 'w', encoding='utf-8') as fp:
+        print('Ref,Path,PosX,PosY', file=fp)
+        for ref, path, pos in placed:
+            print('"{}",{},{:.6f},{:.6f}'.format(ref, path, pos[0] / 1e6, pos[1] / 1e6), file=fp)
+
+# Lay out one project outside the Pcbnew GUI: load the board, place
+# the footprints, then save the board and/or write a placement file.
+# This is what runs in the worker processes when the command line
+# tool is given several boards. Returns the number of footprints
+# placed. With watch set it carries on until interrupted, placing the
+# footprints and saving again whenever the schematic is changed. Each
+# placement is a run as far as statistics go (see start_stats). With
+# replay, the placements are taken from that placement file instead of
+# the schematic; with export, they are saved to one.
+def run_project(board_file, schematic_file=None, output=None, placements=None,
+                parse_workers=None, verbose=None, incremental=None,
+                watch=False, spread=None, auto_scale=None, report=None, profile=None,
+                replay=None, export=None):
+    # Paths are made absolute up front, since place_board changes
+    # into the board's directory.
+    board_file = os.path.abspath(board_file)
+    if schematic_file is None:
+        schematic_file = os.path.splitext(board_file)[0] + '.kicad_sch'
+    schematic_file = os.path.abspath(schematic_file)
+    if output is not None:
+        output = os.path.abspath(output)
+    if placements is not None:
+        placements = os.path.abspath(placements)
+    if export is not None:
+        export = os.path.abspath(export)
+    saved = None
+    handler = start_log(os.path.dirname(board_file), verbose)
+    run = start_stats(board_file, report, profile)
+    try:
+        with stats.phase('load'):
+            board = PcbnewBoard(pcbnew.LoadBoard(board_file))
+            if replay is not None:
+                saved = PlacementFile(replay)
+        placed = place_board(board, schematic_file, parse_workers, incremental, watch,
+                             spread, auto_scale, saved, export)
+        while True:
+            if placements is not None:
+                with stats.phase('write placements'):
+                    write_placements(placements, placed)
+            if output is not None:
+                with stats.phase('save'):
+                    pcbnew.SaveBoard(output, board.board)
+            stop_stats(run)
+            run = None
+            if not watch:
+                break
+            watcher = schematic_watcher(schematic_file, os.path.dirname(board_file), parse_workers)
+            generation = watcher.generation
+            print('{}: {} footprints placed, watching {} sheet files'.format(
+                board_file, len(placed), len(watcher.sheet_files)))
+            try:
+                while watcher.generation == generation:
+                    time.sleep(WATCH_INTERVAL)
+            except KeyboardInterrupt:
+                watcher.stop()
+                break
+            run = start_stats(board_file, report, profile)
+            placed = place_board(board, schematic_file, parse_workers, incremental, watch,
+                                 spread, auto_scale, None, export)
+    finally:
+        if saved is not None:
+            saved.close()
+        stop_stats(run)
+        stop_log(handler)
+    return len(placed)
+
+# Command line entry point. Boards are processed in parallel worker
+# processes when there are several of them; each worker then parses
+# its sheets serially. A single board has its sheets parsed by one
+# worker per CPU.
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Lay out PCB footprints in the same spatial relationships as the components on the schematic.')
+    parser.add_argument('boards', metavar='BOARD', nargs='*',
+                        help='.kicad_pcb file to lay out')
+    parser.add_argument('-s', '--schematic',
+                        help='root schematic file (default: named after the board; single board only)')
+    parser.add_argument('-o', '--output',
+                        help='save the laid out board to this file (single board only)')
+    parser.add_argument('-i', '--in-place', action='store_true',
+                        help='save each laid out board over its input file')
+    parser.add_argument('-p', '--placements', action='store_true',
+                        help='write footprint positions to BOARD-placements.csv next to each board')
+    parser.add_argument('-e', '--export', action='store_true',
+                        help='save the placements to the placement file BOARD-placements.bin next to each board')
+    parser.add_argument('-r', '--replay', metavar='FILE',
+                        help='place the footprints from a saved placement file instead of the schematic')
+    parser.add_argument('--dump', metavar='FILE',
+                        help='print the contents of a placement file as text, and exit')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of boards to process in parallel (default: one per CPU)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only move footprints whose schematic position has changed since the last run')
+    parser.add_argument('--auto-scale', action='store_true',
+                        help='scale each sheet to suit its footprints, and fit the board outline')
+    parser.add_argument('--spread', action='store_true',
+                        help='push overlapping footprints apart after placing them')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep running, placing and saving again whenever the schematic changes (single board only)')
+    parser.add_argument('--stats', action='store_true',
+                        help='append timings and counts for each run to {} next to each board'.format(STATS_FILE))
+    parser.add_argument('--profile', action='store_true',
+                        help='profile each run too, saving the profile to {} (implies --stats)'.format(STATS_PROFILE_FILE))
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='write a debug log next to each board')
+    args = parser.parse_args(argv)
+    if args.dump:
+        try:
+            dump_placement_file(args.dump)
+        except (OSError, ValueError) as err:
+            print('{}: {}'.format(args.dump, err), file=sys.stderr)
+            return 1
+        return 0
+    if not args.boards:
+        parser.error('no boards given')
+    if pcbnew is None:
+        parser.error('the pcbnew module from KiCad is needed to load and save boards')
+    if len(args.boards) > 1 and (args.schematic or args.output or args.watch):
+        parser.error('--schematic, --output and --watch can only be used with a single board')
+    if args.replay and (args.schematic or args.watch or args.export or args.auto_scale):
+        parser.error('--replay can\'t be used with --schematic, --watch, --export or --auto-scale')
+    if not (args.output or args.in_place or args.placements or args.export):
+        parser.error('nothing to do: give --output, --in-place, --placements or --export')
+
+    jobs = []
+    for board_file in args.boards:
+        output = args.output or (board_file if args.in_place else None)
+        placements = os.path.splitext(board_file)[0] + '-placements.csv' if args.placements else None
+        export = os.path.splitext(board_file)[0] + '-placements.bin' if args.export else None
+        jobs.append((board_file, args.schematic, output, placements, export))
+    options = dict(verbose=args.verbose or None, incremental=args.incremental or None,
+                   spread=args.spread or None, auto_scale=args.auto_scale or None,
+                   report=args.stats or args.profile or None, profile=args.profile or None,
+                   replay=args.replay)
+    if args.watch:
+        options['watch'] = True
 
-        for cid in components:
-            print(cid, components[cid], file=DEBUG)
+    failed = 0
+    if len(jobs) == 1 or args.jobs == 1:
+        for job in jobs:
+            try:
+                print('{}: {} footprints placed'.format(
+                    job[0], run_project(*job[:4], parse_workers=0, export=job[4], **options)))
+            except Exception as err:
+                print('{}: failed: {}'.format(job[0], err), file=sys.stderr)
+                failed += 1
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+            futures = [pool.submit(run_project, *job[:4], parse_workers=1, export=job[4], **options)
+                       for job in jobs]
+            for job, future in zip(jobs, futures):
+                try:
+                    print('{}: {} footprints placed'.format(job[0], future.result()))
+                except Exception as err:
+                    print('{}: failed: {}'.format(job[0], err), file=sys.stderr)
+                    failed += 1
+    return 1 if failed else 0
 
-        # Move the components.
-        move_modules(components, board, offsets)
-        pcbnew.Refresh()
 
-SchematicPositionsToLayoutPlugin().register()
+if __name__ == '__main__':
+    sys.exit(main())
+elif __name__ != '__mp_main__' and pcbnew is not None:
+    SchematicPositionsToLayoutPlugin().register()
@@ -1,10 +1,17 @@
 from __future__ import print_function
+import logging
+import math
+import mmap
 import os
 import re
 import sys
 import pcbnew
-from collections import defaultdict
-import shlex
+# The S-expression parser is shared with the KiCad 7/8 plugin, in
+# SchematicSexpr.py next to this file.
+try:
+    from .SchematicSexpr import NodeIndex, map_file, parse_ast
+except ImportError:
+    from SchematicSexpr import NodeIndex, map_file, parse_ast
 
 
 if hasattr(pcbnew, 'GetBuildVersion'):
@@ -19,17 +26,48 @@ else:
     ENABLE_KICAD_V6_API = False
 
 
-DEBUG = None
-
-# Tokenizer for schematic file input lines.
-def tokens(s):
-    return re.split(r' +', s)
+# Diagnostics go to this logger. By default only warnings get through
+# and debug messages cost nothing, not even formatting. With VERBOSE
+# set, each run logs everything to LOG_FILE next to the board.
+log = logging.getLogger('SchematicPositionsToLayout_V5_V6')
+VERBOSE = False
+LOG_FILE = 'schematic-positions-to-layout.debug'
+
+# Schematic file formats, told apart by how the file starts: KiCad 5
+# '.sch' files with an 'EESchema Schematic File' header line, and
+# KiCad 6 '.kicad_sch' files with '(kicad_sch'. Anything else goes by
+# its extension.
+def schematic_format(file):
+    with open(file, 'rb') as fp:
+        head = fp.read(64).lstrip(b'\xef\xbb\xbf \t\r\n')
+    if head.startswith(b'EESchema'):
+        return 'legacy'
+    if head.startswith(b'('):
+        return 'sexpr'
+    return 'sexpr' if file.endswith('.kicad_sch') else 'legacy'
+
+# Patterns for KiCad 5 '.sch' files: the line starting a $Comp or
+# $Sheet block, the L, U and P lines that start a component block as
+# KiCad writes it (reference, ID, x, y), and any of the lines we need
+# in a block, as (tag, rest of line).
+LEGACY_RECORD = re.compile(rb'\$(Comp|Sheet)[ \t\r]*\n')
+LEGACY_COMP = re.compile(rb'[ \t]*L +\S+ +(\S+)[ \t\r]*\n[ \t]*U +\S+ +\S+ +(\S+)[ \t\r]*\n'
+                         rb'[ \t]*P +(-?\d+) +(-?\d+)[ \t\r]*\n')
+LEGACY_FIELD = re.compile(rb'^[ \t]*(L|U|P|S|F0|F1) +([^\r\n]*)', re.M)
 
 # Class to represent a single sheet of a schematic. Has a map from
 # component IDs to positions, a map from sub-sheet names to sub-sheet
 # schematic file names, plus coordinate ranges for the component
-# positions.
+# positions. The file is read by the reader for its format.
 class SchSheet:
+    # Reader method for each format schematic_format() tells apart.
+    READERS = {'legacy': 'read_legacy', 'sexpr': 'read_sexpr'}
+
+    # Top-level node types that walk() looks at in S-expression files.
+    # Everything else (library symbols, wires, text and so on) is
+    # skipped by the parser without being built.
+    PARSE_NODES = ('symbol', 'sheet')
+
     # Extend x- and y-coordinate ranges based on new component or
     # sub-sheet values.
     def extend_range(self, x, y):
@@ -47,180 +85,88 @@ class SchSheet:
         self.components = dict()
         self.sub_sheets = dict()
 
-        print('New sheet from:', file, file=DEBUG)
+        log.debug('New sheet from: %s', file)
 
         self.xrange = [None, None]
         self.yrange = [None, None]
 
-        try:
-            with open(file) as fp:
-                state = None
-                component_ref = None
-                component_id = None
-                component_pos = None
-                sheet_name = None
-                sheet_id = None
-                sheet_file = None
-                sheet_bounds = None
-                for line in fp:
-                    line = line.strip()
-
-                    # Process start and end of component and start and
-                    # end of sheet lines.
-                    if line == '$Comp':
-                        state = 'in-component'
-                    if line == '$EndComp':
-                        state = None
-                        component_ref = None
-                        component_id = None
-                        component_pos = None
-                    if line == '$Sheet':
-                        state = 'in-sheet'
-                    if line == '$EndSheet':
-                        state = None
-                        sheet_name = None
-                        sheet_id = None
-                        sheet_file = None
-                        sheet_bounds = None
-
-                    # Handle component lines.
-                    if state == 'in-component':
-                        if line.startswith('L '):
-                            component_ref = tokens(line)[2]
-                        if line.startswith('U '):
-                            component_id = tokens(line)[3]
-                        if line.startswith('P '):
-                            component_pos = tuple(map(int, tokens(line)[1:]))
-                        # If we have a component reference and a
-                        # component position, record them and include
-                        # the component position in the coordinate
-                        # ranges.
-                        if (component_ref is not None and
-                            component_id is not None and
-                            component_pos is not None):
-                            self.components[component_id] = (component_ref, component_pos)
-                            self.extend_range(component_pos[0], component_pos[1])
-                            component_ref = None
-                            component_id = None
-                            component_pos = None
-
-                    # Handle sub-sheet lines.
-                    if state == 'in-sheet':
-                        if line.startswith('S '):
-                            sheet_bounds = tuple(map(int, tokens(line)[1:]))
-                        if line.startswith('U '):
-                            sheet_id = tokens(line)[1]
-                        if line.startswith('F0 '):
-                            sheet_name = line.split('"')[1]
-                        if line.startswith('F1 '):
-                            sheet_file = line.split('"')[1]
-                        # If we have a sheet name, sheet filename and
-                        # sheet bounds, record them and include the
-                        # bounds in the coordinate ranges.
-                        if (sheet_name is not None and
-                            sheet_id is not None and
-                            sheet_file is not None and
-                            sheet_bounds is not None):
-                            self.sub_sheets[sheet_id] = (sheet_name, sheet_file)
-                            self.extend_range(sheet_bounds[0], sheet_bounds[1])
-                            self.extend_range(sheet_bounds[0] + sheet_bounds[2],
-                                              sheet_bounds[1] + sheet_bounds[3])
-                            sheet_name = None
-                            sheet_id = None
-                            sheet_file = None
-                            sheet_bounds = None
+        getattr(self, self.READERS[schematic_format(file)])(file)
 
+    # Read a KiCad 5 '.sch' file. Rather than going through it line by
+    # line, the file is mapped into memory and scanned for the start of
+    # each $Comp and $Sheet block, and only the lines we need inside
+    # the blocks are looked at. Components are read in one match when
+    # they start as KiCad writes them. Only the values kept are
+    # decoded.
+    def read_legacy(self, file):
+        try:
+            with open(file, 'rb') as fp:
+                data = map_file(fp)
+                try:
+                    for record in LEGACY_RECORD.finditer(data):
+                        start = record.start()
+                        if data[data.rfind(b'\n', 0, start) + 1:start].strip():
+                            continue
+                        kind = record.group(1)
+                        end = data.find(b'$End' + kind, record.end())
+                        if end < 0:
+                            end = len(data)
+                        if kind == b'Comp':
+                            m = LEGACY_COMP.match(data, record.end(), end)
+                            if m is not None:
+                                self.add_component(m.group(2).decode('utf-8'), m.group(1).decode('utf-8'),
+                                                   (int(m.group(3)), int(m.group(4))))
+                                continue
+                        fields = dict()
+                        for m in LEGACY_FIELD.finditer(data, record.end(), end):
+                            fields.setdefault(m.group(1), m.group(2))
+                        if kind == b'Comp':
+                            self.legacy_component(fields)
+                        else:
+                            self.legacy_sheet(fields)
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
         except Exception as err:
-            print('Failed reading schematic file:', err, file=DEBUG)
+            log.error('Failed reading schematic file: %s', err)
             sys.exit(1)
 
-class SchSheetV6(SchSheet):
-    def __init__(self, file):
-        self.components = dict()
-        self.sub_sheets = dict()
-
-        print('New sheet from:', file)
-
-        self.xrange = [None, None]
-        self.yrange = [None, None]
-
-        ast = self.parse_ast(file)
+    # Record a component and include its position in the coordinate
+    # ranges.
+    def add_component(self, component_id, component_ref, component_pos):
+        self.components[component_id] = (component_ref, component_pos)
+        self.extend_range(component_pos[0], component_pos[1])
+
+    # If we have a component reference, ID and position, record them.
+    def legacy_component(self, fields):
+        if b'L' in fields and b'U' in fields and b'P' in fields:
+            self.add_component(fields[b'U'].split()[2].decode('utf-8'),
+                               fields[b'L'].split()[1].decode('utf-8'),
+                               tuple(map(int, fields[b'P'].split())))
+
+    # If we have a sheet name, ID, file name and bounds, record them
+    # and include the bounds in the coordinate ranges.
+    def legacy_sheet(self, fields):
+        if b'S' in fields and b'U' in fields and b'F0' in fields and b'F1' in fields:
+            sheet_bounds = tuple(map(int, fields[b'S'].split()))
+            sheet_id = fields[b'U'].split()[0].decode('utf-8')
+            sheet_name = fields[b'F0'].split(b'"')[1].decode('utf-8')
+            sheet_file = fields[b'F1'].split(b'"')[1].decode('utf-8')
+            self.sub_sheets[sheet_id] = (sheet_name, sheet_file)
+            self.extend_range(sheet_bounds[0], sheet_bounds[1])
+            self.extend_range(sheet_bounds[0] + sheet_bounds[2],
+                              sheet_bounds[1] + sheet_bounds[3])
+
+    # Read a KiCad 6 '.kicad_sch' file, with the same parser as the
+    # KiCad 7/8 plugin.
+    def read_sexpr(self, file):
+        ast = self.parse_ast(file, self.PARSE_NODES)
         self.walk(ast)
 
-    def parse_ast(self, filename):
-        Symbol = str              # A Scheme Symbol is implemented as a Python str
-        Number = (int, float)     # A Scheme Number is implemented as a Python int or float
-        Atom   = (Symbol, Number) # A Scheme Atom is a Symbol or Number
-        List   = list             # A Scheme List is implemented as a Python list
-        Exp    = (Atom, List)     # A Scheme expression is an Atom or List
-        Env    = dict             # A Scheme environment (defined below) 
-                                  # is a mapping of {variable: value}
-
-        def tokenize(chars: str) -> list:
-            "Convert a string of characters into a list of tokens."
-            return shlex.split(chars.replace('(', ' ( ').replace(')', ' ) '))
-
-        def parse(program: str) -> Exp:
-            "Read a Scheme expression from a string."
-            return read_from_tokens(tokenize(program))
-
-        def read_from_tokens(tokens: list) -> Exp:
-            "Read an expression from a sequence of tokens."
-            if len(tokens) == 0:
-                raise SyntaxError('unexpected EOF')
-            token = tokens.pop(0)
-            if token == '(':
-                L = []
-                while tokens[0] != ')':
-                    L.append(read_from_tokens(tokens))
-                tokens.pop(0) # pop off ')'
-                return L
-            elif token == ')':
-                raise SyntaxError('unexpected )')
-            else:
-                return atom(token)
-
-        def atom(token: str) -> Atom:
-            "Numbers become numbers; every other token is a symbol."
-            try: return int(token)
-            except ValueError:
-                try: return float(token)
-                except ValueError:
-                    return Symbol(token)
-        
-        with open(filename,encoding='utf-8') as f:
-            data = f.read()
-
-        #ast = OneOrMore(nestedExpr()).parseString(data, parseAll=True)
-        ast = parse(data)
-        return ast
-    
-    def pick(self, lst, *attribute_names):
-        attr_pool = defaultdict(list)
-        for i in attribute_names:
-            values = i.split()
-            attr_pool[values[0]].append(values)
-        obj = {}
-        for item in lst:
-            if item[0] in attr_pool:
-                token_len = len(attr_pool[item[0]][0])
-                if token_len == 1:  # simple case, direct match
-                    obj[item[0]] = item[1:]
-                else:  # complex, try matching tail tokens
-                    for tokens in attr_pool[item[0]]:
-                        if item[:len(tokens)] == tokens:  # match
-                            obj[' '.join(tokens)] = item[len(tokens):]
-                            break
-        #print("pick:", attribute_names, "got:", obj)
-        return obj
-
-    def pick_property(self, lst, prop_name=None, prop_id=None):
-        for item in lst:
-            if item[0] == 'property' and ( \
-                                           (prop_name is not None and item[1] == prop_name) or \
-                                           (prop_id is not None and int(self.pick(item[1:], 'id')['id'][0]) == prop_id)):
-                #print("prop get:", item[2])
-                return item[2]
+    # Parse an S-expression file with the shared parser (see
+    # SchematicSexpr).
+    def parse_ast(self, filename, keep=None):
+        return parse_ast(filename, keep)[0]
 
     def walk(self, ast):
         def position_convert(x: str):
@@ -229,17 +175,18 @@ class SchSheetV6(SchSheet):
         for i in ast:
             token = i[0]
             if token == 'symbol':  #  Process start and end of component
-                component_ref = self.pick_property(i[1:], prop_id=0)
-                component_id = self.pick(i[1:], "uuid")['uuid'][0]
-                component_pos = tuple(map(position_convert, self.pick(i[1:], "at")['at']))[:2]
+                node = NodeIndex(i)
+                component_ref = node.prop(id=0)
+                component_id = node.field('uuid')[0]
+                component_pos = tuple(map(position_convert, node.field('at')))[:2]
                 self.components[component_id] = (component_ref, component_pos)
                 self.extend_range(component_pos[0], component_pos[1])
             elif token == 'sheet': # Handle sub-sheet
-                sheet_bounds_ast = self.pick(i[1:], 'at', 'size')
-                sheet_bounds = tuple(map(position_convert, sheet_bounds_ast['at'] + sheet_bounds_ast['size']))
-                sheet_id = self.pick(i[1:], "uuid")['uuid'][0]
-                sheet_name = self.pick_property(i[1:], prop_id=0)
-                sheet_file = self.pick_property(i[1:], prop_id=1)
+                node = NodeIndex(i)
+                sheet_bounds = tuple(map(position_convert, node.field('at') + node.field('size')))
+                sheet_id = node.field('uuid')[0]
+                sheet_name = node.prop(id=0)
+                sheet_file = node.prop(id=1)
                 self.sub_sheets[sheet_id] = (sheet_name, sheet_file)
                 self.extend_range(sheet_bounds[0], sheet_bounds[1])
                 self.extend_range(sheet_bounds[0] + sheet_bounds[2],
@@ -247,26 +194,63 @@ class SchSheetV6(SchSheet):
 
 POS_SCALE = 15000
 
-def move_modules(components, board, offsets, kicad_v6=False):
-    for module in board.GetModules() if kicad_v6 is False else board.GetFootprints():
-        old_pos = module.GetPosition()
+# With AUTO_SCALE set, each sheet is drawn at a scale of its own in
+# place of POS_SCALE, worked out from the footprints on the board so
+# that their bounding boxes cover about AUTO_SCALE_FILL of the area the
+# sheet takes up, as the KiCad 7/8 plugin does with courtyards.
+AUTO_SCALE = False
+AUTO_SCALE_FILL = 0.2
+
+# The footprints on a board, and the path of one, in the API of the
+# KiCad version at hand.
+def board_modules(board, kicad_v6=False):
+    return board.GetModules() if kicad_v6 is False else board.GetFootprints()
+
+def module_path(module, kicad_v6=False):
+    return module.GetPath() if kicad_v6 is False else '/' + '/'.join([x.AsString() for x in module.GetPath()])
+
+# Scales for each sheet (for AUTO_SCALE), from the footprints on the
+# board matched to its components. Sheets with no footprints or no
+# area keep POS_SCALE.
+def sheet_scales(sheets, components, board, kicad_v6=False):
+    areas = dict.fromkeys(sheets, 0.0)
+    for module in board_modules(board, kicad_v6):
+        component = components.get(module_path(module, kicad_v6))
+        if component is not None:
+            box = module.GetBoundingBox()
+            areas[component[2]] += float(box.GetWidth()) * box.GetHeight()
+    scales = dict()
+    for sname, s in sheets.items():
+        span = 0.0
+        if s.xrange[0] is not None:
+            span = float(s.xrange[1] - s.xrange[0]) * (s.yrange[1] - s.yrange[0])
+        if areas[sname] > 0 and span > 0:
+            scales[sname] = max(1, int(math.sqrt(areas[sname] / (AUTO_SCALE_FILL * span))))
+        else:
+            scales[sname] = POS_SCALE
+    return scales
+
+# Move the footprints to their components' positions, each sheet
+# drawn at its scale and moved down by its offset (in board units).
+def move_modules(components, board, offsets, scales, kicad_v6=False):
+    for module in board_modules(board, kicad_v6):
         ref = module.GetReference()
-        path = module.GetPath() if kicad_v6 is False else '/' + '/'.join([x.AsString() for x in module.GetPath()])
-        print(ref, path, file=DEBUG)
+        path = module_path(module, kicad_v6)
+        log.debug('%s %s', ref, path)
 
         if path in components:
             ref, pos, sheet = components[path]
             if module.IsLocked():
-                print('  path =', path, '  sheet =', sheet, '  ref =', ref, ' is locked, skip', file=DEBUG)
+                log.debug('  path = %s  sheet = %s  ref = %s is locked, skip', path, sheet, ref)
                 continue
 
-            offset = offsets[sheet]
-            new_pos = pcbnew.wxPoint(pos[0] * POS_SCALE, (pos[1] + offset) * POS_SCALE)
-            print('  path =', path, '  sheet =', sheet, '  ref =', ref,
-                  '  pos =', pos, '  new_pos =', new_pos, file=DEBUG)
+            scale = scales[sheet]
+            new_pos = pcbnew.wxPoint(pos[0] * scale, pos[1] * scale + offsets[sheet])
+            log.debug('  path = %s  sheet = %s  ref = %s  pos = %s  new_pos = %s',
+                      path, sheet, ref, pos, new_pos)
             module.SetPosition(new_pos)
         else:
-            print('  NOT FOUND', file=DEBUG)
+            log.debug('  NOT FOUND')
 
 
 class SchematicPositionsToLayoutPlugin(pcbnew.ActionPlugin):
@@ -277,13 +261,19 @@ class SchematicPositionsToLayoutPlugin(pcbnew.ActionPlugin):
         self.show_toolbar_button = True # Optional, defaults to False
         self.icon_file_name = os.path.join(os.path.dirname(__file__), 'sch2layout.png') # Optional, defaults to ""
     def Run(self):
-        global DEBUG
-        work_dir = os.path.dirname(pcbnew.GetBoard().GetFileName())
-        DEBUG = open(os.path.join(work_dir, 'schematic-positions-to-layout.debug'), 'w')
+        handler = None
+        if VERBOSE:
+            work_dir = os.path.dirname(pcbnew.GetBoard().GetFileName())
+            handler = logging.FileHandler(os.path.join(work_dir, LOG_FILE), 'w', encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+            log.addHandler(handler)
+        log.setLevel(logging.DEBUG if VERBOSE else logging.WARNING)
         try:
             self.DoRun()
         finally:
-            DEBUG.close()
+            if handler is not None:
+                log.removeHandler(handler)
+                handler.close()
 
     def DoRun(self):
         board = pcbnew.GetBoard()
@@ -291,9 +281,9 @@ class SchematicPositionsToLayoutPlugin(pcbnew.ActionPlugin):
         os.chdir(work_dir)
         root_schematic_file = os.path.splitext(in_pcb_file)[0] + ('.kicad_sch' if ENABLE_KICAD_V6_API else '.sch')
         root_schematic_file = str(root_schematic_file) # 对Unicode中文的支持 (support for Chinese Unicode)
-        print('work_dir = {}'.format(work_dir), file=DEBUG)
-        print('in_pcb_file = {}'.format(in_pcb_file), file=DEBUG)
-        print('root_schematic_file = {}'.format(root_schematic_file), file=DEBUG)
+        log.debug('work_dir = %s', work_dir)
+        log.debug('in_pcb_file = %s', in_pcb_file)
+        log.debug('root_schematic_file = %s', root_schematic_file)
 
         # Read schematic sheets, starting at root sheet and following
         # links to sub-sheets.
@@ -303,28 +293,15 @@ class SchematicPositionsToLayoutPlugin(pcbnew.ActionPlugin):
         while len(sheet_queue) > 0:
             sheet_path = list(sheet_queue)[0]
             if sheet_path in sheets:
-                print('Oops. Sheet "{}" turned up twice!'.format(sheet_path), file=DEBUG)
+                log.error('Oops. Sheet "%s" turned up twice!', sheet_path)
                 sys.exit(1)
             sheet_name, file_name = sheet_queue.pop(sheet_path)
-            sheet = SchSheetV6(file_name) if ENABLE_KICAD_V6_API else SchSheet(file_name)
-            print('store to sheet[{}] = {}'.format(sheet_path, file_name), file=DEBUG)
+            sheet = SchSheet(file_name)
+            log.debug('store to sheet[%s] = %s', sheet_path, file_name)
             sheets[sheet_path] = sheet
             for sub_sheet_name in sheet.sub_sheets:
                 sheet_queue[sheet_path + '/' + sub_sheet_name] = sheet.sub_sheets[sub_sheet_name]
 
-        # Find coordinate offsets for placement of each sub-sheet in
-        # the layout.
-        offsets = dict()
-        offsets[''] = 0
-        OFFSET_FACTOR = 1.25
-        running_offset = OFFSET_FACTOR * (sheets[''].yrange[1] - sheets[''].yrange[0])
-        for sname in sheets:
-            if sname == '':
-                continue
-            s = sheets[sname]
-            offsets[sname] = running_offset
-            running_offset += OFFSET_FACTOR * (s.yrange[1] - s.yrange[0])
-
         # Make a master component map, recording the component's
         # position in the sheet.
         components = dict()
@@ -334,16 +311,35 @@ class SchematicPositionsToLayoutPlugin(pcbnew.ActionPlugin):
         for sheet_name in sheets:
             if sheet_name == '':
                 continue
-            print('Processing', sheet_name, file=DEBUG)
+            log.debug('Processing %s', sheet_name)
             s = sheets[sheet_name]
             for cid in s.components:
                 components[sheet_name + '/' + cid] = s.components[cid] + tuple([sheet_name])
 
-        for cid in components:
-            print(cid, components[cid], file=DEBUG)
+        if log.isEnabledFor(logging.DEBUG):
+            for cid in components:
+                log.debug('%s %s', cid, components[cid])
+
+        # Find the scale to draw each sheet at, and coordinate offsets
+        # (in board units) for placement of each sub-sheet in the
+        # layout, one below the other.
+        if AUTO_SCALE:
+            scales = sheet_scales(sheets, components, board, kicad_v6=ENABLE_KICAD_V6_API)
+        else:
+            scales = dict.fromkeys(sheets, POS_SCALE)
+        offsets = dict()
+        offsets[''] = 0
+        OFFSET_FACTOR = 1.25
+        running_offset = OFFSET_FACTOR * (sheets[''].yrange[1] - sheets[''].yrange[0]) * scales['']
+        for sname in sheets:
+            if sname == '':
+                continue
+            s = sheets[sname]
+            offsets[sname] = running_offset
+            running_offset += OFFSET_FACTOR * (s.yrange[1] - s.yrange[0]) * scales[sname]
 
         # Move the components.
-        move_modules(components, board, offsets, kicad_v6=ENABLE_KICAD_V6_API)
+        move_modules(components, board, offsets, scales, kicad_v6=ENABLE_KICAD_V6_API)
         pcbnew.Refresh()
 
 SchematicPositionsToLayoutPlugin().register()
@@ -0,0 +1,194 @@
+# S-expression parser for KiCad schematic files, shared by the KiCad
+# 5/6 and KiCad 7/8 plugins. It only reads files: importing it has no
+# side effects and it needs nothing from pcbnew, so KiCad loading it
+# from the plugins folder alongside the plugins does no harm.
+
+import mmap
+import re
+
+
+# Token pattern for S-expression schematic files, which are scanned
+# as bytes. The groups are: 1 = '(', 2 = ')', 3 = body of a quoted
+# string, 4 = closing quote of the string (missing if the string runs
+# off the end of the file), 5 = bare atom. The index of the last
+# matching group tells you which kind of token you have.
+SEXPR_TOKEN = re.compile(rb'(\()|(\))|"((?:[^"\\]+|\\.)*)(")?|([^\s()"]+)', re.S)
+SEXPR_ESCAPE = re.compile(r'\\(["\\])')
+TOK_OPEN, TOK_CLOSE, TOK_PARTIAL, TOK_STRING, TOK_ATOM = 1, 2, 3, 4, 5
+
+# Pattern for skipping over a node: only brackets and quoted strings
+# (which may contain brackets) matter, so each match passes over
+# everything up to the next of them in one go.
+SEXPR_SKIP = re.compile(rb'[^()"]*(?:(\()|(\))|"(?:[^"\\]+|\\.)*")', re.S)
+
+# Schematic files are memory-mapped and scanned in place, without
+# being read into a string. Every MMAP_RELEASE bytes the pages already
+# scanned are handed back, where the platform allows, so memory use
+# doesn't grow with the size of the file.
+MMAP_RELEASE = 1 << 20
+
+# Contents of an open file for scanning: a read-only memory map, or
+# the bytes read from it if it can't be mapped (if it's empty, say).
+def map_file(fp):
+    try:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return fp.read()
+
+# Hand back the pages of a memory map before pos. Returns the position
+# to do so again at.
+def release_pages(data, pos):
+    if isinstance(data, mmap.mmap) and hasattr(data, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+        data.madvise(mmap.MADV_DONTNEED, 0, pos - pos % mmap.PAGESIZE)
+    return pos + MMAP_RELEASE
+
+# Position just past the end of the node whose opening bracket ends
+# at pos, the node's contents not being needed.
+def skip_sexpr(data, pos):
+    depth = 1
+    release = pos + MMAP_RELEASE
+    for m in SEXPR_SKIP.finditer(data, pos):
+        kind = m.lastindex
+        if kind == TOK_OPEN:
+            depth += 1
+        elif kind == TOK_CLOSE:
+            depth -= 1
+            if depth == 0:
+                return m.end()
+        if m.end() > release:
+            release = release_pages(data, m.end())
+    raise SyntaxError('unexpected EOF')
+
+# Text of a token match, decoded, with escapes in quoted strings
+# resolved. Only tokens that are kept get this far.
+def token_text(kind, m):
+    if kind == TOK_STRING:
+        text = m.group(3).decode('utf-8')
+        if '\\' in text:
+            text = SEXPR_ESCAPE.sub(r'\1', text)
+        return text
+    return m.group(kind).decode('utf-8')
+
+# Index of the children of an S-expression node, built in one pass so
+# that lookups don't have to scan the node: the child with each head
+# symbol, and properties by name. Properties by id are only indexed if
+# they're asked for.
+class NodeIndex:
+    __slots__ = ('fields', 'props', 'prop_ids')
+
+    def __init__(self, node):
+        fields = self.fields = dict()
+        props = self.props = dict()
+        self.prop_ids = None
+        for item in node:
+            if type(item) is list and item:
+                head = item[0]
+                if head != 'property':
+                    fields[head] = item
+                elif len(item) > 2 and item[1] not in props:
+                    props[item[1]] = item
+
+    # Arguments of the child with the given head, as SchSheet.pick()
+    # returns them, e.g. field('at').
+    def field(self, name):
+        return self.fields[name][1:]
+
+    # Value of a property, looked up by name or by id.
+    def prop(self, name=None, id=None):
+        if name is not None:
+            item = self.props.get(name)
+            return item[2] if item is not None else None
+        if self.prop_ids is None:
+            self.prop_ids = dict()
+            for item in self.props.values():
+                for sub in item[3:]:
+                    if type(sub) is list and len(sub) > 1 and sub[0] == 'id':
+                        self.prop_ids.setdefault(int(sub[1]), item[2])
+        return self.prop_ids.get(id)
+
+# Parse an S-expression file into nested lists, scanning it in place.
+# If keep is given, only top-level nodes whose head symbol is in keep
+# are built; the others are skipped by bracket depth. Returns the
+# tree, the number of tokens read and the size of the file in bytes.
+def parse_ast(filename, keep=None):
+    Symbol = str              # A Scheme Symbol is implemented as a Python str
+    Number = (int, float)     # A Scheme Number is implemented as a Python int or float
+    Atom   = (Symbol, Number) # A Scheme Atom is a Symbol or Number
+    List   = list             # A Scheme List is implemented as a Python list
+    Exp    = (Atom, List)     # A Scheme expression is an Atom or List
+    Env    = dict             # A Scheme environment (defined below) 
+                              # is a mapping of {variable: value}
+
+    def parse(data) -> Exp:
+        "Read a Scheme expression from a buffer."
+        return read_from_tokens(data)
+
+    def read_from_tokens(data) -> Exp:
+        "Read an expression from the tokens in a buffer."
+        nonlocal ntokens
+        # Lists under construction are kept on an explicit stack
+        # rather than the call stack, so deeply nested graphics
+        # can't hit the recursion limit.
+        stack = []
+        pos = 0
+        release = MMAP_RELEASE
+        search = SEXPR_TOKEN.search
+        while True:
+            token = search(data, pos)
+            if token is None:
+                break
+            ntokens += 1
+            kind = token.lastindex
+            pos = token.end()
+            if pos > release:
+                release = release_pages(data, pos)
+            if kind == TOK_PARTIAL:
+                raise SyntaxError('unterminated string')
+            if kind == TOK_OPEN:
+                if keep is not None and len(stack) == 1:
+                    # Top-level node: look at its head to decide
+                    # whether to build it or skip it.
+                    head = search(data, pos)
+                    if head is not None and head.lastindex == TOK_ATOM and \
+                       token_text(TOK_ATOM, head) in keep:
+                        stack.append([atom(TOK_ATOM, head)])
+                        pos = head.end()
+                    else:
+                        pos = skip_sexpr(data, pos)
+                else:
+                    stack.append([])
+            elif kind == TOK_CLOSE:
+                if not stack:
+                    raise SyntaxError('unexpected )')
+                L = stack.pop()
+                if not stack:
+                    return L
+                stack[-1].append(L)
+            else:
+                value = atom(kind, token)
+                if not stack:
+                    return value
+                stack[-1].append(value)
+        raise SyntaxError('unexpected EOF')
+
+    def atom(kind: int, token) -> Atom:
+        "Bare numbers become numbers; every other token is a symbol."
+        token = token_text(kind, token)
+        if kind == TOK_STRING:
+            return Symbol(token)
+        try: return int(token)
+        except ValueError:
+            try: return float(token)
+            except ValueError:
+                return Symbol(token)
+
+    ntokens = 0
+    with open(filename, 'rb') as f:
+        data = map_file(f)
+        nbytes = len(data)
+        try:
+            ast = parse(data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return ast, ntokens, nbytes
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Microbenchmark for attribute lookups on parsed symbol and sheet
+# nodes: the old per-call scans (SchSheet.pick / pick_property) against
+# a NodeIndex built once per node, on a symbol-heavy generated sheet.
+#
+#   python benchmarks/bench_lookup.py [--symbols 20000] [--pins 8] [--repeat 5]
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import SchematicPositionsToLayout as sptl
+from bench_placement import sheet_text
+
+
+# The lookups SchSheet.walk() needs, done with pick / pick_property.
+def lookup_pick(sheet, nodes):
+    for i in nodes:
+        if i[0] == 'symbol':
+            sheet.pick_property(i[1:], 'Reference')
+            sheet.pick(i[1:], 'uuid')['uuid'][0]
+            sheet.pick(i[1:], 'at')['at']
+        else:
+            sheet.pick(i[1:], 'at', 'size')
+            sheet.pick(i[1:], 'uuid')['uuid'][0]
+            sheet.pick_property(i[1:], 'Sheetname')
+            sheet.pick_property(i[1:], 'Sheetfile')
+
+
+# The same lookups through a NodeIndex.
+def lookup_index(sheet, nodes):
+    for i in nodes:
+        node = sptl.NodeIndex(i)
+        if i[0] == 'symbol':
+            node.prop('Reference')
+            node.field('uuid')[0]
+            node.field('at')
+        else:
+            node.field('at') + node.field('size')
+            node.field('uuid')[0]
+            node.prop('Sheetname')
+            node.prop('Sheetfile')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark symbol and sheet attribute lookups.')
+    parser.add_argument('--symbols', type=int, default=20000,
+                        help='symbols on the generated sheet (default: %(default)s)')
+    parser.add_argument('--pins', type=int, default=8,
+                        help='pins per symbol (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs, best is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    subs = [('s{}'.format(i), 's{}.kicad_sch'.format(i)) for i in range(args.symbols // 100)]
+    text, _, _ = sheet_text(rng, args.symbols, subs, pins=args.pins)
+    with tempfile.NamedTemporaryFile('w', suffix='.kicad_sch', delete=False) as fp:
+        fp.write(text)
+    try:
+        sheet = sptl.SchSheet.__new__(sptl.SchSheet)
+        ast = sheet.parse_ast(fp.name, sptl.SchSheet.PARSE_NODES)
+    finally:
+        os.unlink(fp.name)
+    nodes = [i for i in ast if type(i) is list]
+
+    print('{} symbol and sheet nodes'.format(len(nodes)))
+    for name, fn in [('pick', lookup_pick), ('NodeIndex', lookup_index)]:
+        best = None
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            fn(sheet, nodes)
+            dt = time.perf_counter() - t
+            best = dt if best is None else min(best, dt)
+        print('{:>10}: {:8.3f} s, {:6.2f} us/node'.format(name, best, best / len(nodes) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
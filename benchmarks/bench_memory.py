@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Memory benchmark for parsing very large schematic files: sheets of a
+# few hundred symbols padded out to tens of MB with embedded image
+# data, as generated schematics with pictures on them are. Each file is
+# parsed in a fresh process, which samples its own resident set size
+# while the parse runs.
+#
+#   python benchmarks/bench_memory.py [--sizes 10,50,100] [--symbols 500]
+#
+# Peak RSS over the baseline (after start-up, before the parse) should
+# stay the same whatever the file size.
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_placement import sheet_text, uuid
+
+PACKAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Run in the child process: parse one file, sampling RSS from /proc
+# every few ms, and print the results as JSON.
+CHILD = r'''
+import json, os, sys, threading, time
+sys.path.insert(0, sys.argv[1])
+import SchematicPositionsToLayout as sptl
+
+def rss():
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+base = peak = rss()
+done = threading.Event()
+def sample():
+    global peak
+    while not done.wait(0.002):
+        peak = max(peak, rss())
+thread = threading.Thread(target=sample)
+thread.start()
+t = time.perf_counter()
+sheet = sptl.SchSheet(sys.argv[2])
+elapsed = time.perf_counter() - t
+done.set()
+thread.join()
+peak = max(peak, rss())
+print(json.dumps({'base': base, 'peak': peak, 'time': elapsed,
+                  'symbols': len(sheet.component_ids)}))
+'''
+
+
+# Write a sheet with nsym symbols and about mb MB of image data.
+def write_sheet(file_name, nsym, mb, seed=1):
+    rng = random.Random(seed)
+    text, _, _ = sheet_text(rng, nsym, [])
+    line = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/')
+                   for _ in range(76))
+    lines_per_image = 10000
+    with open(file_name, 'w') as fp:
+        fp.write(text[:text.rindex(')')])
+        size = 0
+        while size < mb * 1e6:
+            fp.write('  (image (at 100 100) (uuid {})\n    (data\n'.format(uuid(rng)))
+            for _ in range(lines_per_image):
+                fp.write('      ' + line + '\n')
+            fp.write('    )\n  )\n')
+            size += lines_per_image * 83
+        fp.write(')\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark memory use when parsing large schematic files.')
+    parser.add_argument('--sizes', default='10,50,100',
+                        help='comma-separated file sizes in MB (default: %(default)s)')
+    parser.add_argument('--symbols', type=int, default=500,
+                        help='symbols per file (default: %(default)s)')
+    args = parser.parse_args()
+    if not os.path.exists('/proc/self/statm'):
+        sys.exit('RSS sampling needs /proc (Linux)')
+
+    d = tempfile.mkdtemp(prefix='sptl-mem-')
+    print('{:>8} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+        'file MB', 'symbols', 'parse s', 'base MB', 'peak MB', 'delta MB'))
+    try:
+        for mb in [int(n) for n in args.sizes.split(',')]:
+            file_name = os.path.join(d, 'big.kicad_sch')
+            write_sheet(file_name, args.symbols, mb)
+            out = subprocess.check_output([sys.executable, '-c', CHILD, PACKAGE, file_name])
+            r = json.loads(out.decode().splitlines()[-1])
+            print('{:>8.1f} {:>8} {:>9.3f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                os.path.getsize(file_name) / 1e6, r['symbols'], r['time'],
+                r['base'] / 1e6, r['peak'] / 1e6, (r['peak'] - r['base']) / 1e6))
+            os.unlink(file_name)
+    finally:
+        os.rmdir(d)
+
+
+if __name__ == '__main__':
+    main()
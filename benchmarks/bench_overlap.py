@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Benchmark for overlap resolution on synthetic dense boards, as
+# happen when a dense schematic is scaled straight onto the board.
+# There are three cases:
+#
+#   random      a mix of passive, SOIC and QFP sized footprints dropped
+#               at random into an area that could only just hold them
+#               (--density of it covered by courtyards)
+#   grid        3 x 2 mm courtyards on a 1 mm grid, as symbols on a
+#               dense schematic come out at POS_SCALE
+#   coincident  every footprint at the same spot
+#
+#   python benchmarks/bench_overlap.py [--sizes 1000,5000,20000] [--density 0.5]
+#                                      [--cases random,grid,coincident]
+#
+# For each case and size the overlapping pairs are counted before and
+# after (by a sweep, independently of the grid the resolver uses),
+# along with the time spent resolving and how far footprints were
+# moved. The clustered cases have about n * n / 2 overlaps to start
+# with, so they aren't counted beyond 5000 footprints.
+
+from __future__ import print_function
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import SchematicPositionsToLayout as sptl
+
+
+# Courtyard sizes in nm and how common they are.
+FOOTPRINTS = [((1600000, 900000), 50), ((2200000, 1300000), 25),
+              ((6000000, 5400000), 15), ((9400000, 9400000), 4),
+              ((3400000, 3000000), 6)]
+
+
+# A board with n footprints for the given case. Returns the board and
+# a list of (row, (x, y)) targets for every footprint.
+def make_board(case, n, density, seed=1):
+    rng = random.Random(seed)
+    board = sptl.MemoryBoard('dense.kicad_pcb')
+    if case == 'random':
+        sizes = [size for size, weight in FOOTPRINTS for _ in range(weight)]
+        area = 0
+        for i in range(n):
+            w, h = rng.choice(sizes)
+            if rng.random() < 0.5:
+                w, h = h, w
+            area += w * h
+            board.add('U{}'.format(i), '/{}'.format(i), extent=(-w // 2, -h // 2, w - w // 2, h - h // 2))
+        side = int(math.sqrt(area / density))
+        targets = [(row, (rng.randrange(side), rng.randrange(side))) for row in range(n)]
+        return board, targets
+    for i in range(n):
+        board.add('R{}'.format(i), '/{}'.format(i), extent=(-1500000, -1000000, 1500000, 1000000))
+    if case == 'coincident':
+        return board, [(row, (0, 0)) for row in range(n)]
+    columns = int(math.ceil(math.sqrt(n)))
+    return board, [(row, (1000000 * (row % columns), 1000000 * (row // columns)))
+                   for row in range(n)]
+
+
+# Count overlapping pairs (closer than clearance) with a sweep along x.
+def count_overlaps(boxes, clearance):
+    order = sorted(range(len(boxes)), key=lambda i: boxes[i][0])
+    active = []
+    count = 0
+    for i in order:
+        x0, y0, x1, y1 = boxes[i]
+        active = [j for j in active if boxes[j][2] + clearance > x0]
+        for j in active:
+            if boxes[j][1] < y1 + clearance and y0 < boxes[j][3] + clearance:
+                count += 1
+        active.append(i)
+    return count
+
+
+def boxes_at(board, positions):
+    return [(x + fp.extent[0], y + fp.extent[1], x + fp.extent[2], y + fp.extent[3])
+            for fp, (x, y) in zip(board.fps, positions)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark footprint overlap resolution.')
+    parser.add_argument('--sizes', default='1000,5000,20000',
+                        help='comma-separated footprint counts (default: %(default)s)')
+    parser.add_argument('--density', type=float, default=0.5,
+                        help='fraction of the area covered by courtyards in the random case (default: %(default)s)')
+    parser.add_argument('--cases', default='random,grid,coincident',
+                        help='comma-separated cases to run (default: %(default)s)')
+    args = parser.parse_args()
+
+    clearance = sptl.OVERLAP_CLEARANCE
+    print('{:>10} {:>8} {:>10} {:>10} {:>9} {:>12}'.format(
+        'case', 'fps', 'overlaps', 'left', 'time s', 'mean move mm'))
+    for case in args.cases.split(','):
+        for n in [int(s) for s in args.sizes.split(',')]:
+            board, targets = make_board(case, n, args.density)
+            if case == 'random' or n <= 5000:
+                before = count_overlaps(boxes_at(board, [pos for _, pos in targets]), clearance)
+            else:
+                before = '-'
+            index = sptl.FootprintIndex(board)
+            t = time.perf_counter()
+            positions = sptl.spread_footprints(board, index, targets)
+            dt = time.perf_counter() - t
+            after = count_overlaps(boxes_at(board, positions), clearance)
+            moved = sum(math.hypot(x - x0, y - y0) for (x, y), (_, (x0, y0)) in zip(positions, targets))
+            print('{:>10} {:>8} {:>10} {:>10} {:>9.3f} {:>12.2f}'.format(
+                case, n, before, after, dt, moved / n / 1e6))
+
+
+if __name__ == '__main__':
+    main()
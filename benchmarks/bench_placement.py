@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Benchmarks for the schematic -> placement pipeline, run on synthetic
+# schematic hierarchies and an in-memory board, so KiCad isn't needed.
+#
+#   python benchmarks/bench_placement.py [--sizes 10,100,1000] [--keep DIR]
+#
+# For each size (total number of placed symbols) a hierarchy is
+# generated: a root sheet plus one sub-sheet per 500 symbols, half of
+# them instances of one shared "channel" sheet. Timings are reported
+# for parsing, indexing (assembling the hierarchy and the component
+# map), sheet layout (arranged as --layout says) and placement
+# (computing positions and moving footprints). The memory taken by the
+# component map is compared with the dict of tuples keyed by path
+# strings that it replaced.
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import SchematicPositionsToLayout as sptl
+
+
+SYMBOLS_PER_SHEET = 500
+
+
+def uuid(rng):
+    h = '%032x' % rng.getrandbits(128)
+    return '{}-{}-{}-{}-{}'.format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+# Library symbol graphics, which the parser has to get through but
+# which don't contribute to the placement.
+def lib_symbol(n):
+    out = ['    (symbol "Bench:Part{}" (in_bom yes) (on_board yes)'.format(n),
+           '      (property "Reference" "U" (at 0 0 0) (effects (font (size 1.27 1.27))))',
+           '      (symbol "Part{}_1_1"'.format(n)]
+    for p in range(8):
+        out.append('        (polyline (pts (xy {0} 0) (xy {0} 2.54)) (stroke (width 0) (type default)) (fill (type none)))'.format(p))
+        out.append('        (pin passive line (at {} 0 90) (length 2.54) (name "~" (effects (font (size 1.27 1.27)))) (number "{}" (effects (font (size 1.27 1.27)))))'.format(p * 2.54, p + 1))
+    out.append('      )')
+    out.append('    )')
+    return out
+
+
+# Text of one sheet with nsym symbols, each with the given number of
+# pins, and the given sub-sheets, as (name, file) pairs. Returns the
+# text plus the (uuid, reference) pairs of its symbols and the uuids
+# of its sub-sheets.
+def sheet_text(rng, nsym, sub_sheets, ref_base=0, pins=1):
+    out = ['(kicad_sch (version 20230121) (generator bench)',
+           '  (uuid {})'.format(uuid(rng)), '  (paper "A3")', '  (lib_symbols']
+    for n in range(4):
+        out += lib_symbol(n)
+    out.append('  )')
+    symbols = []
+    for s in range(nsym):
+        sid = uuid(rng)
+        ref = 'R{}'.format(ref_base + s)
+        x, y = rng.uniform(0, 400), rng.uniform(0, 280)
+        out += ['  (wire (pts (xy {0:.2f} {1:.2f}) (xy {0:.2f} {2:.2f})) (stroke (width 0) (type default)) (uuid {3}))'.format(x, y, y + 5, uuid(rng)),
+                '  (symbol (lib_id "Bench:Part{}") (at {:.2f} {:.2f} 0) (unit 1)'.format(s % 4, x, y),
+                '    (in_bom yes) (on_board yes) (dnp no)',
+                '    (uuid {})'.format(sid),
+                '    (property "Reference" "{}" (at 0 0 0) (effects (font (size 1.27 1.27))))'.format(ref),
+                '    (property "Value" "10k" (at 0 0 0) (effects (font (size 1.27 1.27))))',
+                '    (property "Footprint" "Bench:R_0603" (at 0 0 0) (effects (font (size 1.27 1.27)) hide))']
+        out += ['    (pin "{}" (uuid {}))'.format(p + 1, uuid(rng)) for p in range(pins)]
+        out += ['  )']
+        symbols.append((sid, ref))
+    sheet_ids = []
+    for i, (name, file_name) in enumerate(sub_sheets):
+        sid = uuid(rng)
+        out += ['  (sheet (at {} {}) (size 20 15)'.format(20 + 30 * (i % 12), 300 + 20 * (i // 12)),
+                '    (uuid {})'.format(sid),
+                '    (property "Sheetname" "{}" (at 0 0 0) (effects (font (size 1.27 1.27))))'.format(name),
+                '    (property "Sheetfile" "{}" (at 0 0 0) (effects (font (size 1.27 1.27))))'.format(file_name),
+                '  )']
+        sheet_ids.append(sid)
+    out.append(')')
+    return '\n'.join(out) + '\n', symbols, sheet_ids
+
+
+# Write a hierarchy with about nsym symbols in total to directory d.
+# Returns the root file name and a MemoryBoard with a footprint for
+# every symbol instance.
+def make_project(d, nsym, seed=1):
+    rng = random.Random(seed)
+    per_sheet = min(nsym, SYMBOLS_PER_SHEET)
+    n_sub = max(0, nsym // per_sheet - 1)
+    n_shared = n_sub // 2
+    sub_sheets = [('chan{}'.format(i), 'channel.kicad_sch') for i in range(n_shared)]
+    sub_sheets += [('sheet{}'.format(i), 'sheet{}.kicad_sch'.format(i)) for i in range(n_sub - n_shared)]
+
+    board = sptl.MemoryBoard(os.path.join(d, 'bench.kicad_pcb'))
+    text, symbols, sheet_ids = sheet_text(rng, per_sheet, sub_sheets)
+    with open(os.path.join(d, 'bench.kicad_sch'), 'w') as fp:
+        fp.write(text)
+    for sid, ref in symbols:
+        board.add(ref, '/' + sid)
+    sub_symbols = dict()
+    for (name, file_name), sheet_id in zip(sub_sheets, sheet_ids):
+        if file_name not in sub_symbols:
+            text, symbols, _ = sheet_text(rng, per_sheet, [], len(board.fps))
+            with open(os.path.join(d, file_name), 'w') as fp:
+                fp.write(text)
+            sub_symbols[file_name] = symbols
+        for sid, ref in sub_symbols[file_name]:
+            board.add(ref, '/{}/{}'.format(sheet_id, sid))
+    return 'bench.kicad_sch', board
+
+
+# The component map as it used to be built: a dict from full path
+# string to (reference, (x, y), sheet path).
+def legacy_component_map(sheets):
+    components = dict()
+    for sheet_path, s in sheets.items():
+        for row, cid in enumerate(s.component_ids):
+            components[sheet_path + '/' + cid] = (s.refs[row], (s.xs[row], s.ys[row]), sheet_path)
+    return components
+
+
+# Memory allocated by fn(*args) and still held by its result.
+def allocated(fn, *args):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn(*args)
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def timed(results, name, fn, *args):
+    t = time.perf_counter()
+    value = fn(*args)
+    results[name] = time.perf_counter() - t
+    return value
+
+
+def bench(nsym, workers, keep=None, layout=None):
+    d = keep or tempfile.mkdtemp(prefix='sptl-bench-')
+    os.makedirs(d, exist_ok=True)
+    cwd = os.getcwd()
+    try:
+        root, board = make_project(d, nsym)
+        size = sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d))
+        os.chdir(d)
+        results = dict()
+        sheet_files = timed(results, 'parse', sptl.read_sheet_files, root, None, workers)
+        t = time.perf_counter()
+        sheets = sptl.sheet_instances(root, sheet_files)
+        components = sptl.component_map(sheets)
+        results['index'] = time.perf_counter() - t
+        offsets, scale = timed(results, 'layout', sptl.sheet_transforms, sheets, layout)
+        t = time.perf_counter()
+        placements = sptl.compute_placements(components, offsets, scale)
+        # The biggest sheets lay out wider than a board can hold; shrink
+        # them as place_board does.
+        index = sptl.FootprintIndex(board)
+        placements, area = sptl.fit_board_range(placements, board, index)
+        moved = sptl.move_modules(placements, board, index=index)
+        results['place'] = time.perf_counter() - t
+        results['dict MB'] = allocated(legacy_component_map, sheets) / 1e6
+        results['store MB'] = allocated(sptl.ComponentStore, sheets) / 1e6
+        return len(board.fps), len(sheets), size, len(moved), results
+    finally:
+        os.chdir(cwd)
+        if keep is None:
+            shutil.rmtree(d)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the schematic to placement pipeline.')
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000',
+                        help='comma-separated symbol counts (default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='parse worker processes, 0 for one per CPU (default: %(default)s)')
+    parser.add_argument('--keep', metavar='DIR',
+                        help='generate the schematics in DIR and leave them there')
+    parser.add_argument('--layout', choices=['pack', 'vertical', 'hierarchy'],
+                        help='sheet layout (default: SHEET_LAYOUT)')
+    args = parser.parse_args()
+
+    print('{:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'symbols', 'sheets', 'MB', 'parse s', 'index s', 'layout s', 'place s', 'moved',
+        'dict MB', 'store MB'))
+    for nsym in [int(n) for n in args.sizes.split(',')]:
+        nfp, nsheets, size, nmoved, r = bench(nsym, args.workers, args.keep, args.layout)
+        print('{:>8} {:>6} {:>9.1f} {:>9.3f} {:>9.3f} {:>9.4f} {:>9.3f} {:>9} {:>9.2f} {:>9.2f}'.format(
+            nfp, nsheets, size / 1e6, r['parse'], r['index'], r['layout'], r['place'], nmoved,
+            r['dict MB'], r['store MB']))
+
+
+if __name__ == '__main__':
+    main()
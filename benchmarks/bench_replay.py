@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Benchmark for saving placements to a placement file and replaying
+# them onto a board, on the synthetic hierarchies of bench_placement.
+#
+#   python benchmarks/bench_replay.py [--sizes 1000,5000,20000]
+#
+# For each size the placements are worked out from the schematic and
+# saved, then the file is opened and replayed onto a fresh board, which
+# is checked against placing it from the schematic. Replay reads no
+# schematic files, so its time is that of opening the file, looking up
+# every footprint and moving it.
+
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_placement import make_project
+import SchematicPositionsToLayout as sptl
+
+
+def positions(board):
+    return [(fp.path, fp.x, fp.y) for fp in board.fps]
+
+
+def bench(nsym):
+    d = tempfile.mkdtemp(prefix='sptl-replay-')
+    cwd = os.getcwd()
+    try:
+        root, board = make_project(d, nsym)
+        os.chdir(d)
+        placements = sptl.schematic_placements(root, None, 1)
+        sptl.move_modules(placements, board)
+        file_name = os.path.join(d, 'bench-placements.bin')
+        t = time.perf_counter()
+        sptl.write_placement_file(file_name, placements)
+        export = time.perf_counter() - t
+
+        _, replayed = make_project(d, nsym)
+        t = time.perf_counter()
+        with sptl.PlacementFile(file_name) as saved:
+            sptl.move_modules(saved, replayed)
+        replay = time.perf_counter() - t
+        if positions(replayed) != positions(board):
+            sys.exit('replayed positions differ for {} symbols'.format(nsym))
+        return len(board.fps), os.path.getsize(file_name), export, replay
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(d)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark saving and replaying placements.')
+    parser.add_argument('--sizes', default='1000,5000,20000',
+                        help='comma-separated symbol counts (default: %(default)s)')
+    args = parser.parse_args()
+
+    print('{:>8} {:>9} {:>9} {:>9}'.format('fps', 'file KB', 'export s', 'replay s'))
+    for nsym in [int(n) for n in args.sizes.split(',')]:
+        nfp, size, export, replay = bench(nsym)
+        print('{:>8} {:>9.1f} {:>9.4f} {:>9.4f}'.format(nfp, size / 1e3, export, replay))
+
+
+if __name__ == '__main__':
+    main()
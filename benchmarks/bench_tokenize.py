@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Benchmark for tokenizing S-expression schematic files: the original
+# shlex path (read the whole file, pad the brackets with spaces and
+# shlex.split it into a list) against the compiled SEXPR_TOKEN pattern
+# run over the memory-mapped file, on generated sheets.
+#
+#   python benchmarks/bench_tokenize.py [--symbols 500,2000] [--pins 4] [--repeat 3]
+#
+# Both tokenizers are run on every sheet and must give the same number
+# of tokens. Speed is the best of --repeat runs; peak memory is taken
+# from tracemalloc on a separate run, so it counts the Python objects
+# made while tokenizing (the file's pages of a memory map aren't
+# allocated by Python and aren't counted).
+
+from __future__ import print_function
+import argparse
+import mmap
+import os
+import random
+import shlex
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import SchematicSexpr as sexpr
+from bench_placement import sheet_text
+
+
+# The tokenizer SchSheet.parse_ast used to have.
+def tokenize_shlex(file_name):
+    with open(file_name, encoding='utf-8') as fp:
+        data = fp.read()
+    return len(shlex.split(data.replace('(', ' ( ').replace(')', ' ) ')))
+
+
+# SEXPR_TOKEN over the mapped file, decoding every token as the parser
+# does for the ones it keeps.
+def tokenize_regex(file_name):
+    count = 0
+    with open(file_name, 'rb') as fp:
+        data = sexpr.map_file(fp)
+        try:
+            for m in sexpr.SEXPR_TOKEN.finditer(data):
+                kind = m.lastindex
+                if kind == sexpr.TOK_PARTIAL:
+                    raise SyntaxError('unterminated string')
+                sexpr.token_text(kind, m)
+                count += 1
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return count
+
+
+def bench(fn, file_name, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        count = fn(file_name)
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    tracemalloc.start()
+    try:
+        fn(file_name)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return count, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the shlex tokenizer against SEXPR_TOKEN.')
+    parser.add_argument('--symbols', default='500,2000',
+                        help='comma-separated symbol counts of the generated sheets (default: %(default)s)')
+    parser.add_argument('--pins', type=int, default=4,
+                        help='pins per symbol (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timing runs, best is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} {:>9} {:>8} {:>9} {:>12} {:>9}'.format(
+        'symbols', 'MB', 'tokens', 'method', 'time s', 'tokens/s', 'peak MB'))
+    for nsym in [int(n) for n in args.symbols.split(',')]:
+        rng = random.Random(1)
+        text, _, _ = sheet_text(rng, nsym, [], pins=args.pins)
+        with tempfile.NamedTemporaryFile('w', suffix='.kicad_sch', delete=False) as fp:
+            fp.write(text)
+        try:
+            size = os.path.getsize(fp.name)
+            counts = set()
+            for name, fn in [('shlex', tokenize_shlex), ('regex', tokenize_regex)]:
+                count, best, peak = bench(fn, fp.name, args.repeat)
+                counts.add(count)
+                print('{:>8} {:>8.2f} {:>9} {:>8} {:>9.4f} {:>12.0f} {:>9.2f}'.format(
+                    nsym, size / 1e6, count, name, best, count / best, peak / 1e6))
+        finally:
+            os.unlink(fp.name)
+        if len(counts) != 1:
+            sys.exit('token counts differ for {} symbols: {}'.format(nsym, sorted(counts)))
+
+
+if __name__ == '__main__':
+    main()